@@ -32,6 +32,13 @@ import plugin
 reload(plugin) # In case we're being reloaded.
 reload(bugmail)
 reload(traceparser)
+reload(engine)
+reload(backends)
+reload(records)
+reload(cache)
+reload(mirror)
+reload(mailsource)
+reload(workqueue)
 
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
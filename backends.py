@@ -0,0 +1,295 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+###
+
+import re
+import urllib
+import sgmllib
+import itertools
+
+import supybot.utils as utils
+import supybot.callbacks as callbacks
+import supybot.plugins.Web.plugin as Web
+
+import records
+
+'''For attachment.cgi in edit mode, how many bytes, starting at the
+   beginning of the page, should we search through to get the title?'''
+ATTACH_TITLE_SIZE = 512
+
+'''When we ask the REST API for bugs with "permissive", it lists the bugs
+   that it couldn't send us in "faults". These are the faultCodes it uses
+   there, and the error names that show_bug.cgi XML uses for the same
+   thing.'''
+REST_ERRORS = { 100 : 'InvalidBugId', 101 : 'NotFound', 102 : 'NotPermitted' }
+
+class Backend(object):
+    """The way that we talk to a particular Bugzilla installation. All
+    HTTP requests go through the BugzillaInstall, so that they share its
+    connections, timeouts and circuit breaker."""
+
+    def __init__(self, install):
+        self.install = install
+        self.url     = install.url
+        self.log     = install.plugin.log
+
+    def getBugs(self, ids, fields=None, attach_fields=None,
+                attachments=False):
+        """Returns a BugRecord for each of the ids (bug ids or aliases),
+        holding at least the listed fields of the bug and its attachments,
+        or all of them if fields is None. Backends only have to fetch
+        attachments if attachments is True; if they don't, the records'
+        attachments are None."""
+        raise NotImplementedError
+
+    def search(self, terms, fields, limit=None):
+        """Runs a QuickSearch, and returns a BugRecord for each bug it
+        finds, holding the listed fields where possible. Returns None if
+        the search turned out to be a bug alias, and so it found only
+        that bug, but we don't have its fields."""
+        raise NotImplementedError
+
+    def changeTimes(self, ids):
+        """Returns a dict of when each of the bugs last changed, by bug id,
+        in a single request. Bugs that we can't see are left out."""
+        raise NotImplementedError
+
+    def attachmentBug(self, attach_id):
+        """Returns the id of the bug that the attachment is on, or None if
+        we couldn't find out."""
+        raise NotImplementedError
+
+class XmlBackend(Backend):
+    """Uses the pages that every Bugzilla has: show_bug.cgi's XML,
+    buglist.cgi's CSV, and attachment.cgi's HTML."""
+
+    def getBugs(self, ids, fields=None, attach_fields=None,
+                attachments=False):
+        queryurl = self.url \
+                   + 'show_bug.cgi?ctype=xml&excludefield=long_desc' \
+                   + '&excludefield=attachmentdata'
+        for id in ids:
+            queryurl = queryurl + '&id=' + urllib.quote(str(id))
+        if fields is not None and self.install.conf.fieldProjection():
+            # Attachments always come back whole, if they come back at
+            # all, so all we can do is ask for them or not.
+            wanted = list(records.ID_FIELDS) + sorted(fields) + ['attachment']
+            for field in wanted:
+                queryurl = queryurl + '&field=' + urllib.quote(field)
+
+        self.log.debug('Getting bugs from %s' % queryurl)
+        headers = {}
+        headers['referer'] = self.url + 'show_bug.cgi?id=' + str(ids[-1])
+        self.log.debug('headers: ' + str(headers))
+
+        r = self.install._get(queryurl, headers=headers, stream=True)
+        try:
+            # Parse the raw bytes, so that the parser reads the encoding
+            # from the XML declaration, instead of requests guessing it.
+            r.raw.decode_content = True
+            return self.install._read(records.parseXml, r.raw, fields,
+                                      attach_fields)
+        except SyntaxError:
+            raise callbacks.Error, 'Got empty or invalid bug content'
+        finally:
+            r.close()
+
+    def search(self, terms, fields, limit=None):
+        # Ask for every column we're going to display, if buglist.cgi can
+        # give it to us, so that we usually don't need the XML at all.
+        columns = ['bug_id']
+        for field in fields:
+            column = records.CSV_COLUMNS.get(field)
+            if column and column not in columns:
+                columns.append(column)
+        queryurl = '%sbuglist.cgi?quicksearch=%s&ctype=csv&columnlist=%s' \
+                   % (self.url, urllib.quote(terms),
+                      urllib.quote(','.join(columns)))
+        if limit:
+            queryurl = '%s&limit=%d' % (queryurl, limit)
+        
+        self.log.debug('Query: %s' % queryurl)
+
+        r = self.install._get(queryurl, stream=True)
+        try:
+            return self.install._read(self._readSearch, r)
+        finally:
+            r.close()
+
+    def _readSearch(self, r):
+        lines = r.iter_lines()
+        first = next(lines, None)
+        if first is None:
+            raise callbacks.Error, 'Got empty CSV'
+        if first.find('DOCTYPE') != -1:
+            return None
+        bugs = records.parseCsv(itertools.chain([first], lines))
+        self.log.debug('Bug IDs: %r' % [bug.bug_id for bug in bugs])
+        return bugs
+
+    def changeTimes(self, ids):
+        queryurl = '%sbuglist.cgi?ctype=csv&columnlist=changeddate' \
+                   '&bug_id_type=anyexact&bug_id=%s' \
+                   % (self.url, urllib.quote(','.join([str(id) for id in ids])))
+        self.log.debug('Getting change times from %s' % queryurl)
+        r = self.install._get(queryurl, stream=True)
+        try:
+            bugs = self.install._read(records.parseCsv, r.iter_lines())
+        finally:
+            r.close()
+        return dict([(bug.bug_id, bug.get('delta_ts', '')) for bug in bugs])
+
+    def attachmentBug(self, attach_id):
+        # The code for getting the title is copied from the Web plugin
+        my_url = '%sattachment.cgi?id=%s&action=edit' % (self.url, attach_id)
+        text = self.install._get(my_url, size=ATTACH_TITLE_SIZE)
+        parser = Web.Title()
+        try:
+            parser.feed(text)
+        except sgmllib.SGMLParseError:
+            self.log.debug('Encountered a problem parsing %s.' % my_url)
+        title  = parser.title.strip()
+        match  = re.search('Attachment.*bug (\d+)', title, re.I)
+        if not match:
+            return None
+        return int(match.group(1))
+
+class RestBackend(Backend):
+    """Uses the REST API of Bugzilla 5 and up, which sends us just the
+    fields we ask for, as JSON."""
+
+    def _getJson(self, path, params):
+        queryurl = '%srest/%s?%s' % (self.url, path,
+                                     urllib.urlencode(params, True))
+        self.log.debug('Getting %s' % queryurl)
+        r = self.install._get(queryurl)
+        try:
+            return r.json()
+        except ValueError:
+            raise callbacks.Error, 'Got invalid JSON from %s' % queryurl
+
+    def _includeFields(self, fields):
+        names = ['id', 'alias']
+        for field in fields:
+            name = records.REST_FIELDS.get(field, field)
+            if name not in names:
+                names.append(name)
+        return ','.join(names)
+
+    def getBugs(self, ids, fields=None, attach_fields=None,
+                attachments=False):
+        # Bug ids and aliases have to be looked up separately, because
+        # searching for both only finds bugs that match both.
+        numbers = [str(i) for i in ids if str(i).isdigit()]
+        aliases = [str(i) for i in ids if not str(i).isdigit()]
+        found = []
+        faults = {}
+        for name, values in (('id', numbers), ('alias', aliases)):
+            if not values: continue
+            params = [(name, value) for value in values]
+            params.append(('permissive', '1'))
+            if fields is not None:
+                params.append(('include_fields',
+                               self._includeFields(fields)))
+            data = self._getJson('bug', params)
+            for bug in data.get('bugs', []):
+                bug = records.fromJson(bug, fields)
+                if bug.bug_id not in [b.bug_id for b in found]:
+                    found.append(bug)
+            for fault in data.get('faults', []):
+                faults[str(fault.get('id')).lower()] = REST_ERRORS.get(
+                    fault.get('faultCode'), 'NotFound')
+        if attachments:
+            self._addAttachments(found, attach_fields)
+        else:
+            for bug in found:
+                bug.attachments = None
+
+        bugs = []
+        for wanted in ids:
+            for bug in found:
+                if str(wanted).lower() in [i.lower() for i in bug.ids()]:
+                    break
+            else:
+                bug = records.BugRecord(str(wanted),
+                    faults.get(str(wanted).lower(), 'NotFound'))
+            if id(bug) not in [id(b) for b in bugs]:
+                bugs.append(bug)
+        return bugs
+
+    def _addAttachments(self, bugs, attach_fields):
+        """Fetches the attachments of all of the bugs in one request."""
+        if not bugs:
+            return
+        names = ['id', 'bug_id', 'is_patch']
+        # The first bug goes in the path, and the rest in "ids".
+        params = [('ids', bug.bug_id) for bug in bugs[1:]]
+        if attach_fields is not None:
+            names.extend([records.REST_ATTACH_FIELDS.get(field, field)
+                          for field in attach_fields])
+        else:
+            names.append('_default')
+            params.append(('exclude_fields', 'data'))
+        params.append(('include_fields', ','.join(names)))
+        data = self._getJson('bug/%s/attachment' % bugs[0].bug_id, params)
+        for bug in bugs:
+            if attach_fields is not None:
+                bug.attach_known = set(attach_fields)
+            bug.attachments = [records.attachmentFromJson(attachment)
+                               for attachment in
+                               data.get('bugs', {}).get(bug.bug_id, [])]
+
+    def search(self, terms, fields, limit=None):
+        params = [('quicksearch', terms),
+                  ('include_fields', self._includeFields(fields))]
+        if limit:
+            params.append(('limit', limit))
+        data = self._getJson('bug', params)
+        return [records.fromJson(bug, fields) for bug in data.get('bugs', [])]
+
+    def changeTimes(self, ids):
+        params = [('id', id) for id in ids]
+        params.append(('include_fields', 'id,last_change_time'))
+        data = self._getJson('bug', params)
+        return dict([(str(bug['id']), bug.get('last_change_time', ''))
+                     for bug in data.get('bugs', [])])
+
+    def attachmentBug(self, attach_id):
+        try:
+            data = self._getJson('bug/attachment/%s' % attach_id,
+                                 [('include_fields', 'bug_id')])
+            attachment = data['attachments'][str(attach_id)]
+            return int(attachment['bug_id'])
+        except (KeyError, TypeError, ValueError, utils.web.Error):
+            return None
+
+'''The backends that an installation can use, by name.'''
+BACKENDS = { 'xml' : XmlBackend, 'rest' : RestBackend }
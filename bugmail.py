@@ -30,6 +30,10 @@
 
 
 import re
+import email
+import hashlib
+import traceback
+from email.Parser import HeaderParser
 from pprint import pprint
 from email.Header import decode_header
 
@@ -37,6 +41,28 @@ from email.Header import decode_header
 # Constants #
 #############
 
+'''The line that starts the signature of a bugmail, which says why each
+   recipient is getting it. It's different in every copy of the same
+   bugmail, so we ignore it when we compare copies. It may be
+   quoted-printable.'''
+SIGNATURE = re.compile(r'^--(?: |=20)\r?$', re.M)
+
+'''How many bytes of the start of a message's body we look at, before we
+   parse the message.'''
+PREFILTER_SIZE = 2048
+
+# The blank line between the headers and the body of a message.
+HEADER_END = re.compile(r'\r?\n\r?\n')
+
+'''The first line of the notices about a change to a bug that another bug
+   depends on. We don't announce these.'''
+DEPENDENCY_CHANGE = re.compile(
+    r'^Bug \d+ depends on bug \d+, which changed state', re.M)
+
+'''A line of the changes table that says that the bug moved to another
+   product.'''
+PRODUCT_CHANGE = re.compile(r'^\s*Product\s*\|', re.M)
+
 '''These are fields that are multi-select fields, so when somebody
    adds something to them, the verbs "added to " or "removed from" should 
    be used instead of the verb "changed" or "set".
@@ -56,6 +82,34 @@ UNWRAP_WHAT = [re.compile('^Attachment .\d+$'), re.compile('^OtherBugsDep'),
    breaks on, in Bugzilla.'''
 BREAKING_CHARACTERS = [' ',',','-']
 
+'''The show_bug.cgi XML names of the fields that can appear in the "What"
+   part of a bugmail "changes" table, for the fields that we can keep
+   track of from bugmail alone. Different Bugzilla versions describe
+   some fields differently, which is why there are duplicates.'''
+FIELD_NAMES = {
+    'Status'          : 'bug_status',
+    'Resolution'      : 'resolution',
+    'Summary'         : 'short_desc',
+    'Severity'        : 'bug_severity',
+    'Priority'        : 'priority',
+    'Assignee'        : 'assigned_to',
+    'AssignedTo'      : 'assigned_to',
+    'QA Contact'      : 'qa_contact',
+    'QAContact'       : 'qa_contact',
+    'Product'         : 'product',
+    'Component'       : 'component',
+    'Version'         : 'version',
+    'Target Milestone': 'target_milestone',
+    'Target_Milestone': 'target_milestone',
+    'OS'              : 'op_sys',
+    'OS/Version'      : 'op_sys',
+    'Hardware'        : 'rep_platform',
+    'Platform'        : 'rep_platform',
+    'Whiteboard'      : 'status_whiteboard',
+    'Status Whiteboard': 'status_whiteboard',
+    'URL'             : 'bug_file_loc',
+}
+
 # The maximum width, in characters, of each field of the "diffs" table.
 WIDTH_WHAT    = 19
 WIDTH_REMOVED = 28
@@ -233,6 +287,87 @@ def _get_header(str):
        retString += string.replace("\n", '').replace("\r", '')
    return retString
 
+def _urlbase(baseHeader):
+    '''Gets the urlbase of the installation from a Message-ID or
+       In-Reply-To header.'''
+    baseMatch = re.search('@((?P<scheme>https?)\.)?(?P<url>.+)>$',
+                          baseHeader, re.I)
+    if baseMatch.group('scheme'):
+        return "%s://%s" % (baseMatch.group('scheme'),
+                            baseMatch.group('url'))
+    # This is a hack to support bugzilla.gnome.org.
+    return 'http://%s/' % baseMatch.group('url')
+
+def rawParts(text):
+    '''Splits a message into its raw header block and the first
+       PREFILTER_SIZE bytes of its raw body, without parsing either.'''
+    end = HEADER_END.search(text)
+    if not end:
+        return text, ''
+    return text[:end.start()], text[end.end():end.end() + PREFILTER_SIZE]
+
+def rawHeader(headers, name):
+    '''Gets the value of a header from a raw header block, or None.'''
+    match = re.search(r'^%s:[ \t]*(.*(?:\r?\n[ \t].*)*)' % re.escape(name),
+                      headers, re.M | re.I)
+    if not match:
+        return None
+    return _get_header(match.group(1)).strip()
+
+def rawBug(headers):
+    '''Returns the (urlbase, bug_id) that a raw header block is about, or
+       None.'''
+    baseHeader = (rawHeader(headers, 'In-Reply-To')
+                  or rawHeader(headers, 'Message-ID'))
+    subject = rawHeader(headers, 'Subject')
+    if not baseHeader or not subject:
+        return None
+    subjectMatch = re.search('\[\w+ (?P<bug_id>\d+)\]', subject)
+    if not subjectMatch or not re.search('@.+>$', baseHeader):
+        return None
+    return _urlbase(baseHeader), int(subjectMatch.group('bug_id'))
+
+def isDependencyNotice(headers, body):
+    '''Whether a message, split by rawParts, is a "depends on bug N,
+       which changed state" notice. We can only tell if the body isn't
+       base64-encoded.'''
+    if re.search('base64', headers + body, re.I):
+        return False
+    return bool(DEPENDENCY_CHANGE.search(body))
+
+def messageKeys(text):
+    '''Returns the keys that we remember having seen a message under,
+       looking only at its headers and its raw body: its Message-ID, and a
+       hash of the parts that are the same in every recipient's copy of
+       the same bugmail. Returns an empty list for mail that isn't
+       bugmail.'''
+    headers = HeaderParser().parsestr(text)
+    if not headers['X-Bugzilla-Product']:
+        return []
+    keys = []
+    if headers['Message-ID']:
+        keys.append(headers['Message-ID'].strip())
+    body = headers.get_payload()
+    if not isinstance(body, basestring):
+        return keys
+    # Every copy gets its own MIME boundary.
+    boundary = headers.get_boundary()
+    if boundary:
+        body = body.replace(boundary, '')
+    sig = SIGNATURE.search(body)
+    if sig:
+        body = body[:sig.start()]
+    # The urlbase is the same for every copy, but only In-Reply-To is the
+    # same all the way through.
+    thread = headers['In-Reply-To'] or headers['Message-ID'] or ''
+    digest = hashlib.sha1()
+    for part in (thread[thread.find('@'):], _get_header(headers['Subject']),
+                 headers['X-Bugzilla-Who'] or '', body.replace('\r\n', '\n')):
+        digest.update(part)
+        digest.update('\0')
+    keys.append(digest.hexdigest())
+    return keys
+
 class BugmailParseError(Exception):
     pass
 
@@ -285,28 +420,31 @@ class Bugmail:
         self.severity  = _get_header(message['X-Bugzilla-Severity'])
         self.priority  = _get_header(message['X-Bugzilla-Priority'])
         self.assignee  = _get_header(message['X-Bugzilla-Assigned-To'])
+        # Only newer Bugzillas send these.
+        self.target_milestone = None
+        if 'X-Bugzilla-Target-Milestone' in message:
+            self.target_milestone = _get_header(
+                message['X-Bugzilla-Target-Milestone'])
+        self.keywords = None
+        if 'X-Bugzilla-Keywords' in message:
+            self.keywords = _get_header(message['X-Bugzilla-Keywords'])
         
         # Get the urlbase of the installation
         if 'In-Reply-To' in message:
             baseHeader = _get_header(message['In-Reply-To'])
         else:
             baseHeader = _get_header(message['Message-ID'])
-        baseMatch = re.search('@((?P<scheme>https?)\.)?(?P<url>.+)>$',
-                              baseHeader, re.I)
-        if baseMatch.group('scheme'):
-            self.urlbase = "%s://%s" % (baseMatch.group('scheme'),
-                                        baseMatch.group('url'))
-        else:
-            # This is a hack to support bugzilla.gnome.org.
-            self.urlbase = 'http://%s/' % baseMatch.group('url')
+        self.urlbase = _urlbase(baseHeader)
 
         # Subject Data
-        subjectMatch = re.search('\s*\[\w+ (?P<bug_id>\d+)\]\s+(?P<new>New:)?',
+        subjectMatch = re.search('\s*\[\w+ (?P<bug_id>\d+)\]\s+(?P<new>New:)?'
+                                 + '\s*(?P<summary>.*)',
                                  _get_header(message['Subject']))
         if not subjectMatch:
             raise NotBugmailException, 'Subject does not contain [Bug #]'
-        self.bug_id = int(subjectMatch.group('bug_id'))
-        self.new    = bool(subjectMatch.group('new'))
+        self.bug_id  = int(subjectMatch.group('bug_id'))
+        self.new     = bool(subjectMatch.group('new'))
+        self.summary = subjectMatch.group('summary').strip()
 
         if message.is_multipart():
             for part in message.walk():
@@ -395,6 +533,50 @@ class Bugmail:
     def diffs(self):
         return self._diffArray
 
+    def canMerge(self, other):
+        '''Whether a later bugmail can be folded into this one with
+           merge().'''
+        return (other.bug_id == self.bug_id
+                and other.urlbase == self.urlbase
+                and other.changer == self.changer
+                and not other.new
+                and not (self.attach_id and other.attach_id))
+
+    def merge(self, other):
+        '''Folds a later bugmail about the same bug, from the same
+           changer, into this one, so that both can be announced as one
+           net change. A field that changed in both keeps the first
+           removed value and the last added value, and a field that
+           changed back to where it started is dropped.'''
+        for diff in other._diffArray:
+            mine = []
+            if ('flags' not in diff and 'attachment' not in diff
+                and diff['what'] not in MULTI_FIELDS):
+                mine = [d for d in self._diffArray
+                        if d['what'] == diff['what']
+                        and 'flags' not in d and 'attachment' not in d]
+            if mine:
+                mine[0]['added'] = diff['added']
+            else:
+                self._diffArray.append(dict(diff))
+        self._diffArray = [d for d in self._diffArray
+                           if 'flags' in d or 'attachment' in d
+                           or d['removed'] != d['added']]
+
+        # The headers of the later bugmail are more current.
+        for name in ('product', 'component', 'status', 'severity',
+                     'priority', 'assignee', 'summary'):
+            setattr(self, name, getattr(other, name))
+        if other.target_milestone is not None:
+            self.target_milestone = other.target_milestone
+        if other.keywords is not None:
+            self.keywords = other.keywords
+        self.attach_id = self.attach_id or other.attach_id
+        self.dupe_of = other.dupe_of or self.dupe_of
+        if other.comment:
+            self.comment = '\n\n'.join(filter(None, [self.comment,
+                                                      other.comment]))
+
     def fields(self):
         # These should be kept in order of what will override what, in terms
         # of watchedItems configuration.
@@ -409,3 +591,45 @@ class Bugmail:
             'bug_id'    : self.bug_id,
             'attach_id' : self.attach_id,
         }
+
+    def bugFields(self):
+        '''Returns what this bugmail tells us about the current values of
+           the bug's fields, keyed by their show_bug.cgi XML name.'''
+        fields = {}
+        if self.new:
+            fields['resolution'] = ''
+        for diff in self._diffArray:
+            name = FIELD_NAMES.get(diff['what'])
+            if name and 'attachment' not in diff and 'flags' not in diff:
+                fields[name] = diff['added']
+        # The headers always have the current value, so they win.
+        fields.update({
+            'product'      : self.product,
+            'component'    : self.component,
+            'bug_status'   : self.status,
+            'bug_severity' : self.severity,
+            'priority'     : self.priority,
+            'assigned_to'  : self.assignee,
+        })
+        if self.summary:
+            fields['short_desc'] = self.summary
+        if self.target_milestone is not None:
+            fields['target_milestone'] = self.target_milestone
+        if self.keywords is not None:
+            fields['keywords'] = self.keywords
+        return fields
+
+def parseText(text):
+    """Parses the text of a message. This is what we run in the parsing
+    processes, so it never raises: it returns (bugmail, None) for bugmail,
+    (None, None) for mail that isn't interesting bugmail, and
+    (None, error) if the message couldn't be parsed."""
+    try:
+        mail = Bugmail(email.message_from_string(text))
+        # This is only for debugging, and it's big.
+        del mail.diffPart
+        return mail, None
+    except (NotBugmailException, email.Errors.MessageParseError):
+        return None, None
+    except:
+        return None, traceback.format_exc()
@@ -0,0 +1,236 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+###
+
+import threading
+from time import time
+from collections import OrderedDict
+
+class BugCache(object):
+    """A thread-safe cache that holds at most "size" items, each for at most
+    "timeout" seconds. When it's full, the least-recently used item goes
+    first. An item can be stored under several keys (like a bug's id and
+    its alias), and evicting any of them evicts all of them."""
+
+    def __init__(self, size, timeout):
+        self.size    = size
+        self.timeout = timeout
+        self._items  = OrderedDict()
+        self._lock   = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, stale=False):
+        """Returns the item stored under key, or None. Items that have
+        timed out stay around until they're pushed out, and are returned
+        if stale is True."""
+        self._lock.acquire()
+        try:
+            entry = self._items.pop(key, None)
+            if entry is None:
+                return None
+            self._items[key] = entry
+            expires, value, keys = entry
+            if expires < time() and not stale:
+                return None
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, keys, value):
+        if not self.size or not self.timeout or not keys:
+            return
+        keys = tuple(keys)
+        entry = (time() + self.timeout, value, keys)
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._evict(key)
+            for key in keys:
+                self._items[key] = entry
+            # Drop whole entries, so that none of them is left behind
+            # under only some of its keys.
+            while len(self._items) > self.size:
+                self._evict(next(iter(self._items)))
+        finally:
+            self._lock.release()
+
+    def refresh(self, key):
+        """Starts the timeout of the item stored under key over, because we
+        know that it's still current."""
+        self._lock.acquire()
+        try:
+            entry = self._items.get(key)
+            if entry is None:
+                return
+            expires, value, keys = entry
+            entry = (time() + self.timeout, value, keys)
+            for k in keys:
+                if k in self._items:
+                    self._items[k] = entry
+        finally:
+            self._lock.release()
+
+    def items(self):
+        """Returns a list of (key, item) tuples, including items that have
+        timed out."""
+        self._lock.acquire()
+        try:
+            return [(key, entry[1]) for key, entry in self._items.items()]
+        finally:
+            self._lock.release()
+
+    def evict(self, key):
+        self._lock.acquire()
+        try:
+            self._evict(key)
+        finally:
+            self._lock.release()
+
+    def _evict(self, key):
+        entry = self._items.pop(key, None)
+        if entry:
+            for k in entry[2]: self._items.pop(k, None)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+        finally:
+            self._lock.release()
+
+class Flight(object):
+    """Something that one thread is fetching, that other threads can wait
+    for."""
+
+    '''How long, in seconds, we wait for another thread's fetch before
+       giving up on it.'''
+    TIMEOUT = 120
+
+    def __init__(self, generation):
+        self.value = None
+        self.generation = generation
+        self._done = threading.Event()
+
+    def wait(self):
+        self._done.wait(self.TIMEOUT)
+        return self.value
+
+class SingleFlight(object):
+    """Keeps track of which keys are being fetched right now, so that
+    threads that want the same thing at the same time only fetch it once.
+    It also keeps track of which keys have changed while they were being
+    fetched, by counting generations: every change starts a new one."""
+
+    '''How many changed keys we remember. If we forget a change, fetches
+       that started before it are all treated as out of date.'''
+    CHANGES_SIZE = 10000
+
+    def __init__(self):
+        self._flights = {}
+        self._changes = OrderedDict()
+        self._generation = 0
+        # Fetches that started before this generation are out of date.
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def claim(self, keys):
+        """Returns the keys that the calling thread should fetch (and then
+        call finish on), a dict of the Flights for the keys that some
+        other thread is already fetching, and the generation that the
+        calling thread's fetch belongs to."""
+        mine   = []
+        theirs = {}
+        self._lock.acquire()
+        try:
+            for key in keys:
+                if key in self._flights:
+                    theirs[key] = self._flights[key]
+                elif key not in mine:
+                    self._flights[key] = Flight(self._generation)
+                    mine.append(key)
+            return mine, theirs, self._generation
+        finally:
+            self._lock.release()
+
+    def generation(self):
+        """Returns the generation that a fetch starting now belongs to."""
+        return self._generation
+
+    def current(self, keys, generation):
+        """Returns whether nothing stored under keys has changed since the
+        fetch of that generation started."""
+        self._lock.acquire()
+        try:
+            if generation < self._floor:
+                return False
+            for key in keys:
+                if self._changes.get(key, 0) > generation:
+                    return False
+            return True
+        finally:
+            self._lock.release()
+
+    def changed(self, key):
+        """Notes that what's stored under key has changed. A fetch of key
+        that's already started won't be shared with anybody else any
+        more: its waiters are woken up with None, so that they fetch it
+        again, and current() says that its results are out of date."""
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._changes.pop(key, None)
+            self._changes[key] = self._generation
+            while len(self._changes) > self.CHANGES_SIZE:
+                old_key, old_generation = self._changes.popitem(last=False)
+                self._floor = old_generation
+            flight = self._flights.pop(key, None)
+        finally:
+            self._lock.release()
+        if flight:
+            flight._done.set()
+
+    def finish(self, key, value, generation):
+        """Hands value to every thread waiting on key. value can be None,
+        if the fetch failed. generation is what claim returned."""
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            # If key changed since we claimed it, somebody else may be
+            # fetching it again by now.
+            if flight is None or flight.generation != generation:
+                return
+            del self._flights[key]
+        finally:
+            self._lock.release()
+        flight.value = value
+        flight._done.set()
@@ -79,6 +79,116 @@ conf.registerGlobalValue(Bugzilla, 'bugSnarferTimeout',
     fetch its data again. If you change the value of this variable, you
     must reload this plugin for the change to take effect."""))
 
+conf.registerGroup(Bugzilla, 'cache',
+    help="""The bot remembers the details of bugs that it has fetched, so
+         that it doesn't have to ask Bugzilla about the same bug over and
+         over.""")
+conf.registerGlobalValue(Bugzilla.cache, 'size',
+    registry.NonNegativeInteger(1000,
+    """How many bugs, at most, should we remember the details of? 0
+    means that nothing is cached. If you change the value of this variable,
+    you must reload this plugin for the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.cache, 'timeout',
+    registry.NonNegativeInteger(300,
+    """How many seconds should we remember the details of a bug for,
+    before fetching them from Bugzilla again? Bugmail about a bug always
+    makes us fetch it again. 0 means that nothing is cached. If you change
+    the value of this variable, you must reload this plugin for the change
+    to take effect."""))
+conf.registerGlobalValue(Bugzilla.cache, 'negativeTimeout',
+    registry.NonNegativeInteger(60,
+    """How many seconds should we remember that a bug or attachment doesn't
+    exist, or isn't accessible, before asking Bugzilla about it again? 0
+    means that we always ask. If you change the value of this variable, you
+    must reload this plugin for the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.cache, 'revalidateInterval',
+    registry.NonNegativeInteger(0,
+    """Every this many seconds, ask each Bugzilla installation (in as few
+    requests as possible) whether the bugs we remember have changed, and
+    fetch only the ones that have. The rest are remembered for another
+    cache.timeout seconds. This is useful when we don't get bugmail for
+    every change. 0 means never. If you change the value of this variable,
+    you must reload this plugin for the change to take effect."""))
+
+conf.registerGroup(Bugzilla, 'mirror',
+    help="""The bot can keep a local copy of what bugmail has told it about
+         each bug, and describe recently-changed bugs from that copy instead
+         of asking Bugzilla.""")
+conf.registerGlobalValue(Bugzilla.mirror, 'database',
+    registry.String('', """The file name of the SQLite database to keep the
+    copy in. Relative file names are in the bot's data directory. If this
+    is empty, no copy is kept. If you change the value of this variable,
+    you must reload this plugin for the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.mirror, 'maxAge',
+    registry.NonNegativeInteger(3600, """If we haven't gotten any bugmail
+    about a bug in this many seconds, ask Bugzilla about the bug instead of
+    using the local copy."""))
+
+conf.registerGroup(Bugzilla, 'queue',
+    help="""The bot can keep the bugmail that it has read in a queue on
+         disk until it has been announced, so that a crash or a reload
+         doesn't lose any of it.""")
+conf.registerGlobalValue(Bugzilla.queue, 'database',
+    registry.String('', """The file name of the SQLite database to keep the
+    queue in. Relative file names are in the bot's data directory. If this
+    is empty, bugmail is announced as soon as it's read, and isn't kept
+    anywhere. If you change the value of this variable, you must reload
+    this plugin for the change to take effect."""))
+
+conf.registerGroup(Bugzilla, 'http',
+    help="""How the bot talks to Bugzilla installations over HTTP.""")
+conf.registerGlobalValue(Bugzilla.http, 'poolSize',
+    registry.PositiveInteger(4, """How many connections to each Bugzilla
+    installation should we keep open for re-use? If you change the value of
+    this variable, you must reload this plugin for the change to take
+    effect."""))
+conf.registerGlobalValue(Bugzilla.http, 'breakerThreshold',
+    registry.PositiveInteger(3, """After this many requests in a row to a
+    Bugzilla installation fail, we stop sending it requests, and describe
+    bugs from what we remember about them (marked as stale) until it
+    responds again. If you change the value of this variable, you must
+    reload this plugin for the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.http, 'breakerCooldown',
+    registry.PositiveInteger(30, """When a Bugzilla installation has
+    stopped responding, how many seconds should we wait between checks to
+    see if it has come back?"""))
+conf.registerGlobalValue(Bugzilla.http, 'chunkSize',
+    registry.PositiveInteger(50, """How many bugs, at most, should we ask
+    for in a single request? Larger lists of bugs are split up into
+    several requests."""))
+conf.registerGlobalValue(Bugzilla.http, 'workers',
+    registry.PositiveInteger(4, """When a list of bugs has been split up
+    into several requests, how many of those requests should we make at
+    the same time?"""))
+
+conf.registerGroup(Bugzilla, 'engine',
+    help="""The bot can do the Bugzilla lookups for commands and snarfed
+         bugs on a small, fixed set of threads, instead of one thread per
+         command.""")
+conf.registerGlobalValue(Bugzilla.engine, 'enabled',
+    registry.Boolean(False, """Determines whether lookups happen on the
+    engine's threads. If you change the value of this variable, you must
+    reload this plugin for the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.engine, 'workers',
+    registry.PositiveInteger(8, """How many lookups can the engine do at
+    the same time? If you change the value of this variable, you must
+    reload this plugin for the change to take effect."""))
+
+conf.registerGroup(Bugzilla, 'parsing',
+    help="""After a mail outage, we can get thousands of bugmails at once.
+         We can parse them in several processes instead of one.""")
+conf.registerGlobalValue(Bugzilla.parsing, 'processes',
+    registry.NonNegativeInteger(0, """How many processes should we parse
+    bugmail in? 0 means that we parse bugmail in the bot's own process. If
+    you change the value of this variable, you must reload this plugin for
+    the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.parsing, 'backlog',
+    registry.PositiveInteger(50, """When we read at least this many
+    messages at once, we parse all of them in the parsing processes."""))
+conf.registerGlobalValue(Bugzilla.parsing, 'messageSize',
+    registry.PositiveInteger(262144, """Messages at least this many bytes
+    long are always parsed in the parsing processes."""))
+
 conf.registerChannelValue(Bugzilla, 'bugFormat',
     registry.SpaceSeparatedListOfStrings(['bug_severity', 'priority',
         'target_milestone', 'assigned_to', 'bug_status', 'short_desc'],
@@ -104,6 +214,11 @@ conf.registerChannelValue(Bugzilla.format, 'bug',
    """When the plugin reports the details of a bug, how should we format 
    that string?"""))
 
+conf.registerChannelValue(Bugzilla, 'bugRangeLimit',
+    registry.PositiveInteger(100, 
+    """The largest number of bugs that somebody can ask for with a range
+    (like 1000-1050) in the "bug" command."""))
+
 conf.registerChannelValue(Bugzilla, 'queryResultLimit',
     registry.PositiveInteger(5, 
     """The number of results to show when using the "query" command."""))
@@ -111,9 +226,63 @@ conf.registerChannelValue(Bugzilla, 'queryResultLimit',
 conf.registerGlobalValue(Bugzilla, 'mbox', 
     registry.String('', """A path to the mbox that we should be watching for
     bugmail.""", private=True))
+conf.registerGlobalValue(Bugzilla, 'maildir',
+    registry.String('', """A path to a Maildir that we should be watching
+    for bugmail, instead of an mbox. If pyinotify is installed, we pick up
+    new mail as soon as it's delivered. If you change the value of this
+    variable, you must reload this plugin for the change to take
+    effect.""", private=True))
 conf.registerGlobalValue(Bugzilla, 'mboxPollTimeout',
     registry.PositiveInteger(10, """How many seconds should we wait between
-    polling the mbox?"""))
+    polling the mbox? When we poll a maildir, this is the longest that we
+    wait between polls."""))
+conf.registerGlobalValue(Bugzilla, 'mboxCompactSize',
+    registry.PositiveInteger(10485760, """We remember how much of the mbox
+    we've already read, and only read what's been added to it since. Once
+    we've read this many bytes of it, we empty it."""))
+
+conf.registerGroup(Bugzilla, 'listener',
+    help="""Bugzilla (or a mail relay) can send bugmail straight to the bot
+         over SMTP, instead of through an mbox or a maildir.""")
+conf.registerGlobalValue(Bugzilla.listener, 'port',
+    registry.NonNegativeInteger(0, """What port should we accept bugmail
+    on? 0 means that we don't listen for bugmail. If you change the value
+    of this variable, you must reload this plugin for the change to take
+    effect."""))
+conf.registerGlobalValue(Bugzilla.listener, 'address',
+    registry.String('127.0.0.1', """What address should we accept bugmail
+    on? If you change the value of this variable, you must reload this
+    plugin for the change to take effect."""))
+conf.registerGlobalValue(Bugzilla.listener, 'queueSize',
+    registry.PositiveInteger(1000, """How many received bugmails can wait
+    to be announced? Once this many are waiting, we tell senders to try
+    again later. If you change the value of this variable, you must reload
+    this plugin for the change to take effect."""))
+
+conf.registerGlobalValue(Bugzilla, 'duplicateWindow',
+    registry.NonNegativeInteger(600, """Bugzilla sends a copy of each
+    bugmail to every recipient. If we get more than one copy of the same
+    bugmail within this many seconds, we only announce the first. 0 means
+    that we announce every copy. If you change the value of this
+    variable, you must reload this plugin for the change to take
+    effect."""))
+conf.registerGlobalValue(Bugzilla, 'coalesceWindow',
+    registry.NonNegativeInteger(0, """When somebody changes the same bug
+    several times in quick succession, we can announce all of those
+    changes together, as one net change. How many seconds after the first
+    bugmail about a bug should we wait for more? 0 means that we announce
+    each bugmail by itself, right away."""))
+conf.registerGlobalValue(Bugzilla, 'bugmailLookahead',
+    registry.NonNegativeInteger(10, """We announce bugmail while we're
+    still reading it. How many bugmails, at most, should we read ahead of
+    the one we're announcing? The bugs of the bugmails that we've read
+    ahead are fetched in the background, if prefetch is on."""))
+conf.registerGlobalValue(Bugzilla, 'prefetch',
+    registry.Boolean(True, """Determines whether we start fetching the
+    details of a bug in the background as soon as we read bugmail about it,
+    instead of waiting until it's announced. If you change the value of
+    this variable, you must reload this plugin for the change to take
+    effect."""))
 
 conf.registerGroup(Bugzilla, 'messages', orderAlphabetically=True, 
     help="""Various messages that can be re-formatted as you wish. If a message
@@ -0,0 +1,115 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+###
+
+import Queue
+import threading
+
+class IOEngine(object):
+    """Runs jobs that talk to Bugzilla on a fixed number of worker threads.
+    Callers hand over a job and go on with their business, and the job's
+    callback is called with the result once it's done. This way, a slow
+    Bugzilla ties up the engine's threads, and not one thread per
+    command."""
+
+    def __init__(self, workers, log):
+        self.log = log
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='Bugzilla I/O %d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, function, callback, errback):
+        """Calls function() on one of the engine's threads, and then
+        callback(result). If function throws an exception, errback() is
+        called instead, from inside the except block, so that it can use
+        sys.exc_info()."""
+        self._jobs.put((function, callback, errback))
+
+    def stop(self):
+        for thread in self._threads:
+            self._jobs.put(None)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            function, callback, errback = job
+            try:
+                try:
+                    result = function()
+                except:
+                    errback()
+                    continue
+                callback(result)
+            except:
+                self.log.exception('Exception in Bugzilla I/O job:')
+
+class CircuitBreaker(object):
+    """Keeps track of whether a Bugzilla is answering us. After threshold
+    failures in a row, the breaker "opens," and requests to that Bugzilla
+    should fail right away instead of waiting to time out. It closes again
+    the next time a request succeeds."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures  = 0
+        self.isOpen    = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return not self.isOpen
+
+    def succeeded(self):
+        self._lock.acquire()
+        try:
+            self.failures = 0
+            self.isOpen   = False
+        finally:
+            self._lock.release()
+
+    def failed(self):
+        """Records a failure. Returns True if this failure is the one that
+        opened the breaker."""
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.failures >= self.threshold and not self.isOpen:
+                self.isOpen = True
+                return True
+            return False
+        finally:
+            self._lock.release()
@@ -0,0 +1,451 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+
+import os
+import re
+import mmap
+import errno
+import Queue
+import smtpd
+import asyncore
+import threading
+from time import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+'''How old, in seconds, a dot-lock on the mbox has to be before we decide
+   that whoever took it crashed without removing it, and break it.'''
+STALE_DOTLOCK_AGE = 180
+
+# A line that starts a new message in an mbox.
+FROM_LINE = re.compile(r'^From ', re.M)
+
+###########
+# Locking #
+###########
+
+class LockBusy(IOError):
+    """Somebody else has the mbox locked right now."""
+
+def lock_file(f):
+    """Lock file f using lockf and dot locking. We never wait for somebody
+    else's lock, because we're called from the bot's main loop: if the file
+    is locked, throws LockBusy, and the caller can try again later. Returns
+    whether we took a dot-lock."""
+    lock_name = f.name + '.lock'
+    dotlock_done = False
+    try:
+        if fcntl:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    raise LockBusy, '%s is locked' % f.name
+                raise
+
+        try:
+            pre_lock = _create_temporary(lock_name)
+        except (IOError, OSError), e:
+            # We can't create files next to mboxes in directories that we
+            # don't own. lockf is all that we can do, there.
+            if e.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
+                return False
+            raise
+        pre_lock.close()
+
+        try:
+            _break_stale_dotlock(lock_name)
+            try:
+                if hasattr(os, 'link'):
+                    os.link(pre_lock.name, lock_name)
+                else:
+                    os.rename(pre_lock.name, lock_name)
+                dotlock_done = True
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+        finally:
+            _remove(pre_lock.name)
+        if not dotlock_done:
+            raise LockBusy, '%s is dot-locked' % f.name
+
+    except:
+        if fcntl:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+        if dotlock_done:
+            os.remove(lock_name)
+        raise
+    return dotlock_done
+
+def _break_stale_dotlock(path):
+    """Removes the dot-lock at path if it's older than STALE_DOTLOCK_AGE."""
+    try:
+        age = time() - os.stat(path).st_mtime
+    except OSError, e:
+        if e.errno == errno.ENOENT: return
+        raise
+    if age > STALE_DOTLOCK_AGE:
+        _remove(path)
+
+def _remove(path):
+    """Removes the file at path, if it's still there."""
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT: raise
+
+def _create_temporary(path):
+    """Create a temp file based on path and open for reading and writing."""
+    file_name = '%s.%s.%s' % (path, int(time()), os.getpid())
+    fd = os.open(file_name, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+    try:
+        return open(file_name, 'rb+')
+    finally:
+        os.close(fd)
+
+def unlock_file(f, dotlocked=True):
+    """Unlock file f using lockf and dot locking."""
+    if fcntl:
+        fcntl.lockf(f, fcntl.LOCK_UN)
+    if dotlocked:
+        os.remove(f.name + '.lock')
+
+########
+# Mbox #
+########
+
+def split_messages(data, start, end):
+    """Yields (begin, body, finish) for each message in data[start:end],
+    where the message came from data[begin:finish], and its text (without
+    its "From " line) is data[body:finish]. data can be a string or an
+    mmap."""
+    starts = [m.start() for m in FROM_LINE.finditer(data, start, end)]
+    # Anything before the first "From " line isn't a message.
+    for i, begin in enumerate(starts):
+        if i + 1 < len(starts):
+            finish = starts[i + 1]
+        else:
+            finish = end
+        body = data.find('\n', begin, finish)
+        if body == -1: continue
+        yield begin, body + 1, finish
+
+class MboxReader(object):
+    """Reads the messages that have been delivered to an mbox since we last
+    looked at it. We remember how far into the mbox we've dealt with every
+    message (in the file at state_path, so that it survives reloads and
+    crashes), and we only drop that part of the mbox once it's more than
+    compact_size bytes long."""
+
+    def __init__(self, path, state_path, compact_size):
+        self.path = path
+        self.state_path = state_path
+        self.compact_size = compact_size
+        self.inode, self.offset = self._loadState()
+        # How far we've read, which may be past what we've dealt with.
+        self.position = self.offset
+        # The start of each message that we've read but that hasn't been
+        # dealt with yet, by its end.
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def _loadState(self):
+        try:
+            f = open(self.state_path)
+            try:
+                inode, offset = f.read().split()
+                return int(inode), int(offset)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None, 0
+
+    def _saveState(self):
+        temp = self.state_path + '.tmp'
+        f = open(temp, 'w')
+        try:
+            f.write('%s %s\n' % (self.inode, self.offset))
+        finally:
+            f.close()
+        os.rename(temp, self.state_path)
+
+    def read(self):
+        """Returns an iterator of (token, text) tuples, one for each new
+        message in the mbox. Each message's text is only read from the mbox
+        as the iterator gets to it. Call done(token) once a message has been
+        dealt with. Until then, it will be read again after a restart, and
+        by the next call to read()."""
+        boxFile = open(self.path, 'r+b')
+        try:
+            dotlocked = lock_file(boxFile)
+            try:
+                size, ranges = self._readLocked(boxFile)
+            finally:
+                unlock_file(boxFile, dotlocked)
+            if not ranges:
+                boxFile.close()
+                return iter([])
+            data = mmap.mmap(boxFile.fileno(), size, access=mmap.ACCESS_READ)
+        except:
+            boxFile.close()
+            raise
+        return self._messages(boxFile, data, ranges)
+
+    def _messages(self, boxFile, data, ranges):
+        # Mail is only ever appended to the mbox, and we only compact it
+        # in read(), so the first size bytes stay put until we're done.
+        try:
+            for token, body in ranges:
+                yield token, data[body:token]
+        finally:
+            data.close()
+            boxFile.close()
+
+    def done(self, token):
+        """Marks the message that read() returned token for as dealt with."""
+        self._lock.acquire()
+        try:
+            self._pending.pop(token, None)
+            if self._pending:
+                offset = min(self._pending.values())
+            else:
+                offset = self.position
+            if offset != self.offset:
+                self.offset = offset
+                self._saveState()
+        finally:
+            self._lock.release()
+
+    def _readLocked(self, boxFile):
+        self._lock.acquire()
+        try:
+            # Anything that wasn't dealt with last time gets read again.
+            self._pending.clear()
+            self.position = self.offset
+            stat = os.fstat(boxFile.fileno())
+            # If the mbox has been replaced or emptied by somebody else, we
+            # start again from the beginning.
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.inode = stat.st_ino
+                self.offset = self.position = 0
+                self._saveState()
+            size = stat.st_size
+            if self.offset >= self.compact_size:
+                size = self._compact(boxFile, size)
+            if size == self.position:
+                return size, []
+
+            # Each message's token is where it ends.
+            data = mmap.mmap(boxFile.fileno(), size,
+                             access=mmap.ACCESS_READ)
+            try:
+                ranges = []
+                for begin, body, finish in split_messages(data,
+                                                          self.position,
+                                                          size):
+                    self._pending[finish] = begin
+                    ranges.append((finish, body))
+            finally:
+                data.close()
+            self.position = size
+            if not ranges:
+                self.done(None)
+            return size, ranges
+        finally:
+            self._lock.release()
+
+    def _compact(self, boxFile, size):
+        """Drops the part of the mbox that we've dealt with, keeping
+        anything after it. Returns the new size of the mbox."""
+        boxFile.seek(self.offset)
+        rest = boxFile.read(size - self.offset)
+        boxFile.seek(0)
+        boxFile.write(rest)
+        boxFile.truncate(len(rest))
+        boxFile.flush()
+        self.offset = self.position = 0
+        self._saveState()
+        return len(rest)
+
+###########
+# Maildir #
+###########
+
+class MaildirReader(object):
+    """Reads the messages that have been delivered to a Maildir. Each
+    message is moved from new/ to cur/ once the caller says it has dealt
+    with it, so a crash loses nothing: at worst, some messages are read
+    again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.new = os.path.join(path, 'new')
+        self.cur = os.path.join(path, 'cur')
+
+    def read(self):
+        """Yields a (token, text) tuple for each message in new/, oldest
+        first. Call done(token) once a message has been dealt with."""
+        names = [n for n in os.listdir(self.new) if not n.startswith('.')]
+        # Maildir file names start with their delivery time.
+        names.sort()
+        for name in names:
+            source = os.path.join(self.new, name)
+            try:
+                f = open(source, 'rb')
+                try:
+                    text = f.read()
+                finally:
+                    f.close()
+            except IOError, e:
+                # Somebody else picked it up before we got to it.
+                if e.errno == errno.ENOENT: continue
+                raise
+            yield name, text
+
+    def done(self, token):
+        """Moves the message that read() returned token for to cur/."""
+        name = token
+        if ':' not in name:
+            name += ':2,'
+        try:
+            os.rename(os.path.join(self.new, token),
+                      os.path.join(self.cur, name))
+        except OSError, e:
+            if e.errno != errno.ENOENT: raise
+
+    def watch(self, callback):
+        """Calls callback (from another thread) whenever mail is delivered
+        to the Maildir. Returns an object with a stop() method, or None if
+        we can't watch the Maildir (because pyinotify isn't installed)."""
+        if pyinotify is None:
+            return None
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.ThreadedNotifier(manager,
+                                              lambda event: callback())
+        notifier.setDaemon(True)
+        notifier.start()
+        manager.add_watch(self.new,
+                          pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE)
+        return notifier
+
+########
+# SMTP #
+########
+
+class _PrivateMap:
+    """Puts a dispatcher into its listener's own socket map, instead of
+    asyncore's global one, so that the listener's thread only ever
+    services our sockets."""
+
+    def add_channel(self, map=None):
+        self._map = self.socket_map
+        asyncore.dispatcher.add_channel(self, self.socket_map)
+
+class _BugmailChannel(_PrivateMap, smtpd.SMTPChannel):
+    def __init__(self, server, conn, addr):
+        self.socket_map = server.socket_map
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+
+class _BugmailServer(_PrivateMap, smtpd.SMTPServer):
+    def __init__(self, address, queue, socket_map):
+        self.socket_map = socket_map
+        smtpd.SMTPServer.__init__(self, address, None)
+        self.queue = queue
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            _BugmailChannel(self, conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        try:
+            self.queue.put_nowait(data)
+        except Queue.Full:
+            # The sender will try again later.
+            return '451 Too much bugmail waiting, try again later'
+        return None
+
+class SmtpListener(object):
+    """Accepts bugmail over SMTP, on its own thread. At most queue_size
+    messages wait to be taken; after that, senders are asked to try again
+    later."""
+
+    def __init__(self, address, queue_size):
+        self.queue = Queue.Queue(queue_size)
+        self.socketMap = {}
+        self.server = _BugmailServer(address, self.queue, self.socketMap)
+        self.stopped = False
+        self.thread = threading.Thread(target=self._serve,
+                                       name='Bugzilla SMTP listener')
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+
+    def _serve(self):
+        while not self.stopped:
+            asyncore.loop(timeout=1, count=1, map=self.socketMap)
+
+    def take(self):
+        """Waits for mail to arrive, and returns the text of every message
+        that's waiting. Once the listener has been stopped, returns what's
+        left, and then None."""
+        texts = []
+        if not self.stopped:
+            texts.append(self.queue.get())
+        while True:
+            try:
+                texts.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        # stop() wakes us up with an empty message.
+        texts = [text for text in texts if text]
+        if self.stopped and not texts:
+            return None
+        return texts
+
+    def stop(self):
+        """Stops accepting mail. What was accepted can still be taken."""
+        self.stopped = True
+        self.thread.join()
+        # This closes the server, and hangs up on anybody still sending.
+        asyncore.close_all(self.socketMap)
+        try:
+            # Wake up take().
+            self.queue.put_nowait('')
+        except Queue.Full:
+            pass
@@ -0,0 +1,170 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+###
+
+import json
+import sqlite3
+import threading
+from time import time
+
+import cache
+import records
+
+'''When we can't keep the attachment index in a database, how many
+   attachments, at most, should we remember the bug of?'''
+ATTACH_INDEX_SIZE = 10000
+
+class AttachmentIndex(object):
+    """Remembers which bug each attachment is on, in memory. BugMirror
+    does the same thing, in its database."""
+
+    def __init__(self):
+        # Attachments never move to another bug, so this never times out.
+        self._bugs = cache.BugCache(ATTACH_INDEX_SIZE, float('inf'))
+
+    def noteAttachments(self, install, attachments):
+        """attachments is a list of (attach_id, bug_id) tuples."""
+        for attach_id, bug_id in attachments:
+            self._bugs.put([(install, int(attach_id))], int(bug_id))
+
+    def attachmentBug(self, install, attach_id):
+        """Returns the id of the bug the attachment is on, or None."""
+        return self._bugs.get((install, int(attach_id)))
+
+class BugMirror(object):
+    """A local copy of what bugmail has told us about each bug, stored in
+    an SQLite database so that it survives restarts. There is one row per
+    bug, per installation."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS bugs (
+                                install TEXT NOT NULL,
+                                bug_id  INTEGER NOT NULL,
+                                fields  TEXT NOT NULL,
+                                updated REAL NOT NULL,
+                                PRIMARY KEY (install, bug_id))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS attachments (
+                                install   TEXT NOT NULL,
+                                attach_id INTEGER NOT NULL,
+                                bug_id    INTEGER NOT NULL,
+                                PRIMARY KEY (install, attach_id))""")
+        self._db.commit()
+
+    def update(self, install, bug_id, fields):
+        """Merges fields into what we already know about a bug."""
+        self._lock.acquire()
+        try:
+            row = self._db.execute(
+                'SELECT fields FROM bugs WHERE install = ? AND bug_id = ?',
+                (install, int(bug_id))).fetchone()
+            known = {}
+            if row:
+                known = json.loads(row[0])
+            known.update(fields)
+            self._db.execute('INSERT OR REPLACE INTO bugs VALUES (?, ?, ?, ?)',
+                             (install, int(bug_id), json.dumps(known), time()))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def forget(self, install, bug_id):
+        """Drops what we know about a bug, because it has changed in a way
+        that we didn't keep track of."""
+        self._lock.acquire()
+        try:
+            self._db.execute(
+                'DELETE FROM bugs WHERE install = ? AND bug_id = ?',
+                (install, int(bug_id)))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def get(self, install, bug_id, fields, max_age):
+        """Returns a BugRecord for the bug if we know the values of all of
+        the listed fields, and we heard about the bug in the last max_age
+        seconds (or ever, if max_age is None). Otherwise, returns None."""
+        if not str(bug_id).isdigit():
+            return None
+        oldest = 0
+        if max_age is not None:
+            oldest = time() - max_age
+        self._lock.acquire()
+        try:
+            row = self._db.execute(
+                'SELECT fields FROM bugs WHERE install = ? AND bug_id = ?'
+                ' AND updated >= ?',
+                (install, int(bug_id), oldest)).fetchone()
+        finally:
+            self._lock.release()
+        if not row:
+            return None
+        known = json.loads(row[0])
+        for field in fields:
+            if field not in known:
+                return None
+        return records.BugRecord(str(bug_id), None, known)
+
+    def noteAttachments(self, install, attachments):
+        """attachments is a list of (attach_id, bug_id) tuples."""
+        rows = [(install, int(attach_id), int(bug_id))
+                for attach_id, bug_id in attachments]
+        if not rows:
+            return
+        self._lock.acquire()
+        try:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)', rows)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def attachmentBug(self, install, attach_id):
+        """Returns the id of the bug the attachment is on, or None."""
+        self._lock.acquire()
+        try:
+            row = self._db.execute(
+                'SELECT bug_id FROM attachments'
+                ' WHERE install = ? AND attach_id = ?',
+                (install, int(attach_id))).fetchone()
+        finally:
+            self._lock.release()
+        if row:
+            return row[0]
+        return None
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
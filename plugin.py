@@ -40,121 +40,112 @@ import supybot.ircutils as ircutils
 import supybot.registry as registry
 import supybot.schedule as schedule
 import supybot.callbacks as callbacks
-import supybot.plugins.Web.plugin as Web
 
 import re
 import urllib
-import xml.dom.minidom as minidom
 
 import bugmail
 import traceparser
+import engine
+import backends
+import records
+import cache
+import mirror
+import workqueue
+import mailsource
 
-import mailbox
-import email
 from time import time, sleep
-import os
-import errno
 import sys
+import threading
+import itertools
+from collections import deque
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import socket
 import requests
-try:
-    import fcntl
-except ImportError:
-    fcntl = None
-
-'''The maximum amount of time that the bugmail poller will wait
-   for a dotlock to be released, in seconds, before throwing an
-   exception.'''
-MAX_DOTLOCK_WAIT = 300
-
-'''For attachment.cgi in edit mode, how many bytes, starting at the
-   beginning of the page, should we search through to get the title?'''
-ATTACH_TITLE_SIZE = 512
-
-######################################
-# Utility Functions for Mbox Polling #
-###################################### 
-
-def _lock_file(f):
-    """Lock file f using lockf and dot locking."""
-    # XXX This seems to be causing problems in directories that we don't own.
-    return
-    dotlock_done = False
+'''When fetching lots of bugs, how many characters of bug ids, at most,
+   should we put into a single show_bug.cgi URL? This keeps us well under
+   the URL length limits of common web servers and proxies.'''
+MAX_URL_IDS_LENGTH = 1500
+
+'''What reading the body of a streamed response can throw, when Bugzilla
+   stops sending halfway through it.'''
+BODY_ERRORS = (requests.RequestException,
+               requests.packages.urllib3.exceptions.HTTPError, socket.error)
+
+'''When polling a maildir without inotify, the shortest time that we wait
+   between polls, in seconds.'''
+MIN_POLL_INTERVAL = 1
+
+'''When parsing a backlog of bugmail in several processes, how many
+   messages we hand to a process at once.'''
+PARSE_CHUNK_SIZE = 10
+
+'''How long, in seconds, we wait for the parsing processes to parse a
+   message, or a batch of a backlog, before we decide that they're stuck,
+   and parse it ourselves.'''
+PARSE_TIMEOUT = 60
+
+'''How many bugmails we read from the work queue at once.'''
+QUEUE_BATCH_SIZE = 20
+
+'''How long, in seconds, unloading the plugin waits for the bugmail that
+   the SMTP listener has already accepted to be dealt with.'''
+LISTENER_DRAIN_TIMEOUT = 10
+
+'''How many bugmails, at most, we remember having seen, so that we only
+   announce one copy of each.'''
+SEEN_MAIL_SIZE = 10000
+
+'''The errors that Bugzilla gives for bugs that don't exist or that we can't
+   see. We remember these for a little while, so that we don't keep asking
+   about them.'''
+NEGATIVE_ERRORS = ('NotFound', 'NotPermitted', 'InvalidBugId')
+
+####################
+# Fetching Helpers #
+####################
+
+def _chunkIds(ids, size):
+    """Splits a list of bug ids into lists of at most size ids, that will
+    each fit into a single URL."""
+    chunks = []
+    chunk  = []
+    length = 0
+    for id in ids:
+        id_length = len(urllib.quote(str(id))) + len('&id=')
+        if chunk and (len(chunk) >= size
+                      or length + id_length > MAX_URL_IDS_LENGTH):
+            chunks.append(chunk)
+            chunk  = []
+            length = 0
+        chunk.append(id)
+        length += id_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def _lookahead(items, size):
+    """Yields the items of the iterator items in order, but reads up to
+    size items ahead of the caller."""
+    buffered = deque()
+    for item in items:
+        buffered.append(item)
+        if len(buffered) > size:
+            yield buffered.popleft()
+    while buffered:
+        yield buffered.popleft()
+
+def _inParallel(function, items, workers):
+    """Calls function on each of the items, in up to workers threads at
+    once, and returns the results in the same order as the items."""
+    if len(items) < 2 or workers < 2:
+        return [function(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
     try:
-        if fcntl:
-            fcntl.lockf(f, fcntl.LOCK_EX)
-
-        pre_lock = _create_temporary(f.name + '.lock')
-        pre_lock.close()
-
-        start_dotlock = time()
-        while (not dotlock_done):
-            try:
-                if hasattr(os, 'link'):
-                    os.link(pre_lock.name, f.name + '.lock')
-                    dotlock_done = True
-                    os.unlink(pre_lock.name)
-                else:
-                    os.rename(pre_lock.name, f.name + '.lock')
-                    dotlock_done = True
-            except OSError, e:
-                if e.errno != errno.EEXIST: raise
-
-            if time() - start_dotlock > MAX_DOTLOCK_WAIT:
-                raise IOError, 'Timed-out while waiting for dot-lock'
-
-    except:
-        if fcntl:
-            fcntl.lockf(f, fcntl.LOCK_UN)
-        if dotlock_done:
-            os.remove(f.name + '.lock')
-        raise
-
-def _create_temporary(path):
-    """Create a temp file based on path and open for reading and writing."""
-    file_name = '%s.%s.%s' % (path, int(time()), os.getpid())
-    fd = os.open(file_name, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-    try:
-        return open(file_name, 'rb+')
+        return pool.map(function, items)
     finally:
-        os.close(fd)
-
-def _unlock_file(f):
-    """Unlock file f using lockf and dot locking."""
-    if fcntl:
-        fcntl.lockf(f, fcntl.LOCK_UN)
-    if os.path.exists(f.name + '.lock'):
-        os.remove(f.name + '.lock')
-
-def _message_factory(fp):
-    try:
-        return email.message_from_file(fp)
-    except email.Errors.MessageParseError:
-        # Don't return None since that will
-        # stop the mailbox iterator
-        return ''
-
-#######################
-# XML-Parsing Helpers #
-#######################
-
-def _getTagText(bug, field):
-    # XXX This should probably support multiplicable fields
-    node = bug.getElementsByTagName(field)
-    node_text = None
-    if node:
-        node_text = _getXmlText(node)
-        # Include Resolution in status
-        if field == 'bug_status':
-            res_node = bug.getElementsByTagName('resolution')
-            if res_node:
-                node_text += ' ' + _getXmlText(res_node)
-    return node_text
-
-def _getXmlText(node):
-    try:
-        return node[0].childNodes[0].data
-    except:
-        return ''
+        pool.close()
 
 ####################################################
 # Classes and Utilities for Bugzilla Installations #
@@ -183,6 +174,10 @@ class BugzillaName(registry.String):
 class BugzillaNames(registry.SpaceSeparatedListOfStrings):
     Value = BugzillaName
 
+class BackendName(registry.OnlySomeStrings):
+    """That is not a known way of talking to Bugzilla."""
+    validStrings = tuple(sorted(backends.BACKENDS.keys()))
+
 def registerBugzilla(name, url=''):
     if (not re.match('\w+$', name)):
         s = utils.str.normalizeWhitespace(BugzillaName.__doc__)
@@ -195,6 +190,24 @@ def registerBugzilla(name, url=''):
         installation. This must be identical to the urlbase (or sslbase)
         parameter used by the installation. (The url that shows up in 
         emails.) It must end with a forward slash."""))
+    conf.registerGlobalValue(install, 'backend',
+        BackendName('xml', """Determines how we talk to this installation.
+        "xml" uses show_bug.cgi, buglist.cgi and attachment.cgi, which
+        every Bugzilla has. "rest" uses the REST API of Bugzilla 5 and up,
+        which is faster."""))
+    conf.registerGlobalValue(install, 'fieldProjection',
+        registry.Boolean(True, """Determines whether we should ask this
+        installation to only send us the bug fields that we display. Bugzillas
+        that don't support this just send every field, so you should only
+        need to turn this off if the installation does something strange
+        with it."""))
+    conf.registerGroup(install, 'timeouts')
+    conf.registerGlobalValue(install.timeouts, 'connect',
+        registry.PositiveInteger(10, """How many seconds should we wait for
+        a connection to this installation before giving up?"""))
+    conf.registerGlobalValue(install.timeouts, 'read',
+        registry.PositiveInteger(30, """How many seconds should we wait for
+        this installation to send us data before giving up?"""))
     conf.registerChannelValue(install, 'queryTerms',
         registry.String('',
         """Additional search terms in QuickSearch format, that will be added to
@@ -245,6 +258,9 @@ def registerBugzilla(name, url=''):
 class BugzillaNotFound(registry.NonExistentRegistryEntry):
     pass
 
+class BugzillaUnavailable(utils.web.Error):
+    pass
+
 class BugzillaInstall:
     """Represents a single Bugzilla."""
 
@@ -259,101 +275,112 @@ class BugzillaInstall:
             raise BugzillaNotFound, 'No Bugzilla called %s' % name
         self.url  = self.conf.url()
         self.name = name
+        self.backend = backends.BACKENDS[self.conf.backend()](self)
         #self.aliases = self.conf.aliases()
         #self.aliases.append(name)
         self.plugin = plugin
 
     def query(self, terms, total, channel, limit=None):
-        # Build the query URL
+        # Build the search terms
         baseTerms = self.plugin.registryValue('bugzillas.%s.queryTerms' \
                                               % self.name , channel)
         fullTerms = "%s %s" % (terms, baseTerms)
         fullTerms = fullTerms.strip()
-        queryurl = '%sbuglist.cgi?quicksearch=%s&ctype=csv&columnlist=bug_id' \
-                   % (self.url, urllib.quote(fullTerms))
-        if not total and limit:
-            queryurl = '%s&limit=%d' % (queryurl, limit)
-        
-        self.plugin.log.debug('Query: %s' % queryurl)
-
-        bug_csv = utils.web.getUrl(queryurl)
-        if not bug_csv:
-             raise callbacks.Error, 'Got empty CSV'
-
-        if bug_csv.find('DOCTYPE') == -1:
-            bug_ids = bug_csv.split("\n")
-            self.plugin.log.debug('Bug IDs: %r' % bug_ids)
-            del bug_ids[0] # Removes the "bug_id" header.
+        fields = self.plugin.registryValue('bugFormat', channel)
+        if 'bug_status' in fields:
+            fields = fields + ['resolution']
+        if total:
+            bugs = self.backend.search(fullTerms, [])
         else:
-            # Searching a bug alias will return just that bug.
-            bug_ids = [fullTerms]
+            bugs = self.backend.search(fullTerms, fields, limit)
 
-        if not bug_ids:
+        if bugs is None:
+            if total:
+                return ['1 results for "%s."' % terms]
+            return self.getBugs([fullTerms], channel)
+
+        if not bugs:
             return ['No results for "%s."' % terms]
 
         if total:
-            return ['%d results for "%s."' % (len(bug_ids), terms)]
+            return ['%d results for "%s."' % (len(bugs), terms)]
+        elif not bugs[0].covers(fields):
+            # The search couldn't give us some of the fields.
+            return self.getBugs([bug.bug_id for bug in bugs], channel)
         else:
-            return self.getBugs(bug_ids, channel)
+            return self._formatBugs(bugs, channel)
 
     def getAttachments(self, attach_ids, channel):
-        # The code for getting the title is copied from the Web plugin
-        attach_url = '%sattachment.cgi?id=%s&action=edit'
         attach_bugs = {}
+        bug_ids = []
         lines = []
 
-        # Get the bug ID that each bug is on.
+        # Get the bug ID that each bug is on, from the attachment index if
+        # we can, and otherwise from Bugzilla.
+        index = self.plugin.attachIndex
         for attach_id in attach_ids:
-            my_url = attach_url % (self.url, attach_id)
-            text = utils.web.getUrl(my_url, size=ATTACH_TITLE_SIZE)
-            parser = Web.Title()
-            try:
-                parser.feed(text)
-            except sgmllib.SGMLParseError:
-                self.plugin.log.debug('Encountered a problem parsing %u.', my_url)
-            title  = parser.title.strip()
-            match  = re.search('Attachment.*bug (\d+)', title, re.I)
-            if not match:
+            bug_id = index.attachmentBug(self.name.lower(), attach_id)
+            missing_key = (self.name.lower(), 'attachment', str(attach_id))
+            if bug_id is None and not self.plugin.missingBugs.get(missing_key):
+                bug_id = self.backend.attachmentBug(attach_id)
+                if bug_id is None:
+                    self.plugin.missingBugs.put([missing_key], True)
+                else:
+                    index.noteAttachments(self.name.lower(),
+                                          [(attach_id, bug_id)])
+            if bug_id is None:
                 err = 'Attachment %s was not found or is not accessible.' \
                        % attach_id
-                lines.append(self.plugin._formatLine(err, channel, 'attachment'))
+                lines.append(self.plugin._formatLine(err, channel,
+                                                     'attachment'))
                 continue
-            bug_id = match.group(1)
+            bug_id = str(bug_id)
             if bug_id not in attach_bugs:
                 attach_bugs[bug_id] = []
+                bug_ids.append(bug_id)
             attach_bugs[bug_id].append(attach_id)
 
-        # Get the attachment details
-        for bug_id, attachments in attach_bugs.iteritems():
-            self.plugin.log.debug('Getting attachments %r on bug %s' % \
-                                  (attachments, bug_id))
-            attach_strings = self.getAttachmentsOnBug(attachments,
-                                 bug_id, channel, do_error=True)
-            lines.extend(attach_strings)
+        # Get the attachment details, fetching all the bugs at once.
+        if bug_ids:
+            self.plugin.log.debug('Getting attachments %r' % attach_bugs)
+            for bug in self._getBugRecords(bug_ids, attachments=True):
+                attachments = attach_bugs.get(bug.bug_id)
+                if attachments is None: continue
+                attach_strings = self._formatAttachments(bug, attachments,
+                                     channel, do_error=True)
+                lines.extend(attach_strings)
         return lines
 
     def getBugs(self, ids, channel, show_url=True):
         """Returns an array of formatted strings describing the bug ids,
         using preferences appropriate to the passed-in channel."""
 
-        bugs = self._getBugXml(ids)
+        fields = self.plugin.registryValue('bugFormat', channel)
+        if 'bug_status' in fields:
+            fields = fields + ['resolution']
+        bugs = self._getBugRecords(ids, fields)
+        return self._formatBugs(bugs, channel, show_url)
+
+    def _formatBugs(self, bugs, channel, show_url=True):
         bug_strings = [];
         for bug in bugs:
-            bug_id = bug.getElementsByTagName('bug_id')[0].childNodes[0].data
+            bug_id = bug.bug_id
             if show_url:
                 bug_url = '%sshow_bug.cgi?id=%s' \
                           % (self.url, urllib.quote(bug_id))
             else:
                 bug_url = bug_id + ':'
 
-            if bug.hasAttribute('error'):
+            if bug.error:
                 bug_strings.append(self._bugError(bug, bug_url))
             else:
                 bug_data = []
                 for field in self.plugin.registryValue('bugFormat', channel):
-                    node_text = _getTagText(bug, field)
+                    node_text = bug.text(field)
                     if node_text:
                         bug_data.append(node_text)
+                if bug.stale:
+                    bug_data.append('(stale)')
                 bug_strings.append('Bug ' + bug_url + ' ' + \
                                    ', '.join(bug_data))
 
@@ -362,30 +389,32 @@ class BugzillaInstall:
         return bug_strings
 
     def getAttachmentsOnBug(self, attach_ids, bug_id, channel, do_error=False):
-        bug = self._getBugXml([bug_id])[0]
-        if bug.hasAttribute('error'):
+        bug = self._getBugRecords([bug_id], attachments=True)[0]
+        return self._formatAttachments(bug, attach_ids, channel, do_error)
+
+    def _formatAttachments(self, bug, attach_ids, channel, do_error=False):
+        if bug.error:
             if do_error:
-                return [self._bugError(bug, bug_id)]
+                return [self._bugError(bug, bug.bug_id)]
             else:
                 return []
 
-        attachments = bug.getElementsByTagName('attachment')
         attach_strings = []
         # Sometimes we're passed ints, sometimes strings. We want to always
         # have a list of ints so that "in" works below.
         attach_ids = [int(id) for id in attach_ids]
-        for attachment in attachments:
-            attach_id = int(_getTagText(attachment, 'attachid'))
+        for attachment in bug.attachments or []:
+            attach_id = int(attachment['attachid'])
             if attach_id not in attach_ids: continue
 
             attach_url = '%sattachment.cgi?id=%s&action=edit' % (self.url,
                                                                   attach_id)
             attach_data = []
             for field in self.plugin.registryValue('attachFormat', channel):
-                node_text = _getTagText(attachment, field)
+                node_text = attachment.get(field)
                 if node_text:
                     if (field == 'type'
-                        and attachment.getAttribute('ispatch') == '1'):
+                        and attachment.get('ispatch') == '1'):
                         node_text = 'patch'
                     attach_data.append(node_text)
             attach_strings.append('Attachment ' + attach_url + ' ' \
@@ -409,11 +438,15 @@ class BugzillaInstall:
                 status['removed'] = status['removed'] + ' ' \
                                     + resolution['removed']
                     
+        # Every channel shares one fetch of the bug (and the bug it was
+        # duped to), which happens the first time some channel needs it.
+        mail_bugs = {}
         for irc in world.ircs:
             for channel in irc.state.channels.keys():
                 if self._shouldAnnounceBugInChannel(bug, channel):
                     try:
-                        self._handleBugmailForChannel(bug, irc, channel)
+                        self._handleBugmailForChannel(bug, irc, channel,
+                                                      mail_bugs)
                     except:
                         self.plugin.log.exception(\
                         'Exception while handling mail for bug %s on %s.%s'\
@@ -426,7 +459,7 @@ class BugzillaInstall:
     # Bugmail Handling: Major Subroutines #
     #######################################
 
-    def _handleBugmailForChannel(self, bug, irc, channel):
+    def _handleBugmailForChannel(self, bug, irc, channel, mail_bugs=None):
         self.plugin.log.debug('Handling bugmail in channel %s.%s' \
                       % (irc.network, channel))
         report = self.reportFor(channel)
@@ -486,17 +519,39 @@ class BugzillaInstall:
         if lines:
             self.plugin.log.debug('Reporting %d change(s) to %s' \
                                   % (len(lines), channel))
-            if say_attachments:
-                attach_strings = self.getAttachmentsOnBug(say_attachments, \
-                    bug.bug_id, channel)
+            say_bug  = self.plugin._shouldSayBug(bug.bug_id, channel)
+            say_dupe = (bug.dupe_of
+                        and self.plugin._shouldSayBug(bug.dupe_of, channel))
+            if say_attachments or say_bug or say_dupe:
+                mail_bugs = self._bugmailRecords(bug, mail_bugs)
+            if say_attachments and bug.bug_id in mail_bugs:
+                attach_strings = self._formatAttachments(
+                    mail_bugs[bug.bug_id], say_attachments, channel)
                 lines.extend(attach_strings)
-            if self.plugin._shouldSayBug(bug.bug_id, channel):
-                lines.extend(self.getBugs([bug.bug_id], channel))
-            if bug.dupe_of and self.plugin._shouldSayBug(bug.dupe_of, channel): 
-                lines.extend(self.getBugs([bug.dupe_of], channel))
+            if say_bug and bug.bug_id in mail_bugs:
+                lines.extend(self._formatBugs([mail_bugs[bug.bug_id]],
+                                              channel))
+            if say_dupe and bug.dupe_of in mail_bugs: 
+                lines.extend(self._formatBugs([mail_bugs[bug.dupe_of]],
+                                              channel))
             for line in lines:
                 self._send(irc, channel, line)
                 
+    def _bugmailRecords(self, bug, mail_bugs=None):
+        """Fetches the bug that a bugmail is about, and the bug it was
+        duped to, in one request. Fills in and returns mail_bugs, a dict of
+        BugRecords by bug id, unless it has already been filled in."""
+        if mail_bugs is None:
+            mail_bugs = {}
+        if not mail_bugs:
+            ids = [bug.bug_id]
+            if bug.dupe_of:
+                ids.append(bug.dupe_of)
+            for record in self._getBugRecords(ids, attachments=True):
+                if record.bug_id.isdigit():
+                    mail_bugs[int(record.bug_id)] = record
+        return mail_bugs
+
     def _diff_messages(self, channel, bm, diff):
         lines = []
 
@@ -643,34 +698,318 @@ class BugzillaInstall:
     # General Helper Subroutines #
     ##############################
             
-    def _getBugXml(self, ids):
-        queryurl = self.url \
-                   + 'show_bug.cgi?ctype=xml&excludefield=long_desc' \
-                   + '&excludefield=attachmentdata'
+    def _get(self, url, headers=None, size=None, stream=False):
+        """Fetches url using this installation's pooled HTTP session.
+        Returns the Response, or if size is specified, just the first
+        size bytes of the body."""
+        breaker = self.plugin.breaker(self.name)
+        if not breaker.allow():
+            raise BugzillaUnavailable, '%s is not responding.' % self.url
+        session = self.plugin.httpSession(self.name)
+        stream = stream or size is not None
+        try:
+            r = session.get(url, headers=headers, stream=stream,
+                            timeout=self._timeout())
+            if r.status_code >= 500:
+                self._failed()
+            r.raise_for_status()
+            if size is not None:
+                try:
+                    data = r.raw.read(size, decode_content=True)
+                finally:
+                    r.close()
+                breaker.succeeded()
+                return data
+        except requests.HTTPError, e:
+            raise utils.web.Error, utils.web.strError(e)
+        except BODY_ERRORS, e:
+            self._failed()
+            raise utils.web.Error, utils.web.strError(e)
+        breaker.succeeded()
+        return r
+
+    def _read(self, function, *args):
+        """Returns function(*args), which reads the body of a Response
+        that _get returned with stream=True. The body arrives after _get
+        has returned, so a Bugzilla that stops sending it counts against
+        the breaker here, like one that doesn't answer at all."""
+        try:
+            return function(*args)
+        except BODY_ERRORS, e:
+            self._failed()
+            raise utils.web.Error, utils.web.strError(e)
+
+    def _timeout(self):
+        return (self.conf.timeouts.connect(), self.conf.timeouts.read())
+
+    def _failed(self):
+        if self.plugin.breaker(self.name).failed():
+            self.plugin.log.warning('%s is not responding; failing fast '
+                                    'until it comes back.' % self.url)
+            self._scheduleProbe()
+
+    def _scheduleProbe(self):
+        cooldown = self.plugin.registryValue('http.breakerCooldown')
+        schedule.addEvent(self._startProbe, time() + cooldown,
+                          name=self.plugin.probeName(self.name))
+
+    def _startProbe(self):
+        # Scheduled events run on the bot's main loop, and the probe can
+        # take as long as our timeouts, so it gets a thread of its own.
+        thread = threading.Thread(target=self._probe,
+                                  name='Bugzilla probe %s' % self.name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _probe(self):
+        """Checks, in the background, whether a Bugzilla that stopped
+        responding has come back."""
+        session = self.plugin.httpSession(self.name)
+        try:
+            r = session.head(self.url, timeout=self._timeout())
+            if r.status_code >= 500:
+                raise utils.web.Error, 'HTTP %s' % r.status_code
+        except (requests.RequestException, utils.web.Error), e:
+            self.plugin.log.debug('%s is still not responding: %s'
+                                  % (self.url, e))
+            if not self.plugin.stopped:
+                self._scheduleProbe()
+            return
+        self.plugin.log.info('%s is responding again.' % self.url)
+        self.plugin.breaker(self.name).succeeded()
+
+    def _cacheKey(self, bug_id):
+        return (self.name.lower(), str(bug_id))
+
+    def _getBugRecords(self, ids, fields=None, attachments=False):
+        """Returns a BugRecord for each of the ids, in the order they were
+        asked for. Bugs that are in the plugin's cache don't get fetched.
+        If you only need certain fields, list them in fields, and then
+        the plugin's bug mirror can also answer for the bug. If you need
+        the bugs' attachments, pass attachments=True."""
+        ids = [str(id).strip() for id in ids]
+        ids = [id for id in ids if id]
+        found   = {}
+        missing = []
+        bug_mirror = self.plugin.bugMirror
+        bug_fields, attach_fields = self.plugin.wantedFields()
         for id in ids:
-            queryurl = queryurl + '&id=' + urllib.quote(str(id))
-
-        self.plugin.log.debug('Getting bugs from %s' % queryurl)
-        headers = {}
-        headers['referer'] = self.url + 'show_bug.cgi?id=' + ids[-1]
-        self.plugin.log.debug('headers: ' + str(headers))
-
-        r = requests.get(queryurl, headers=headers)
-        bugxml = r.text
-        if not bugxml:
-            raise callbacks.Error, 'Got empty bug content'
-       
-        try: 
-            return minidom.parseString(bugxml).getElementsByTagName('bug')
-        except Exception:
+            bug = self.plugin.bugCache.get(self._cacheKey(id))
+            if bug is None:
+                bug = self.plugin.missingBugs.get(self._cacheKey(id))
+            if bug is not None and not bug.covers(fields or bug_fields,
+                                                  attach_fields, attachments):
+                bug = None
+            if bug is None and fields and bug_mirror and not attachments:
+                max_age = self.plugin.registryValue('mirror.maxAge')
+                bug = bug_mirror.get(self.name.lower(), id, fields, max_age)
+            if bug is not None:
+                found[id] = bug
+            elif id not in missing:
+                missing.append(id)
+
+        leftover = []
+        if missing:
+            self.plugin.log.debug('Bugs not in cache: %r' % missing)
+            # If another thread is already fetching some of these bugs,
+            # we wait for its results instead of fetching them again.
+            in_flight = self.plugin.inFlight
+            mine, theirs, generation = in_flight.claim(
+                [self._cacheKey(id) for id in missing])
+            ours = [id for id in missing if self._cacheKey(id) in mine]
+            try:
+                leftover = self._fetchRecords(ours, found, bug_fields,
+                                              attach_fields, attachments,
+                                              generation)
+            finally:
+                for id in ours:
+                    bug = found.get(id)
+                    # Nobody else gets a bug that changed while we were
+                    # fetching it.
+                    if bug is not None and not in_flight.current(
+                            [self._cacheKey(i) for i in bug.ids()],
+                            generation):
+                        bug = None
+                    in_flight.finish(self._cacheKey(id), bug, generation)
+
+            # If the other thread failed, we try for ourselves.
+            again = []
+            for id in missing:
+                flight = theirs.get(self._cacheKey(id))
+                if flight is None: continue
+                bug = flight.wait()
+                if bug is None or not bug.covers(attachments=attachments):
+                    again.append(id)
+                else:
+                    found[id] = bug
+            leftover.extend(self._fetchRecords(again, found, bug_fields,
+                                               attach_fields, attachments))
+
+        return [found[id] for id in ids if id in found] + leftover
+
+    def _fetchRecords(self, ids, found, bug_fields, attach_fields,
+                      attachments=False, generation=None):
+        """Fetches the bugs from Bugzilla, caches them, and puts them into
+        found, like _matchRecords. generation is the inFlight generation
+        that the fetch started in."""
+        in_flight = self.plugin.inFlight
+        if generation is None:
+            generation = in_flight.generation()
+        if not ids:
             return []
+        chunks  = _chunkIds(ids, self.plugin.registryValue('http.chunkSize'))
+        fetch   = lambda chunk: self.backend.getBugs(chunk, bug_fields,
+                                                     attach_fields, attachments)
+        fetched = []
+        try:
+            for chunk_bugs in _inParallel(fetch, chunks,
+                                  self.plugin.registryValue('http.workers')):
+                fetched.extend(chunk_bugs)
+        except utils.web.Error:
+            if self.plugin.breaker(self.name).allow():
+                raise
+            self._staleRecords(ids, found)
+            return []
+        attach_ids = []
+        for bug in fetched:
+            keys = [self._cacheKey(id) for id in bug.ids()]
+            # Errors go into a separate cache with a shorter timeout,
+            # because they usually mean that the bug doesn't exist *yet*,
+            # or that somebody typo'd.
+            if bug.error in NEGATIVE_ERRORS:
+                bug_cache = self.plugin.missingBugs
+            elif not bug.error:
+                bug_cache = self.plugin.bugCache
+                attach_ids.extend([(a['attachid'], bug.bug_id)
+                                   for a in bug.attachments or []])
+            else:
+                continue
+            # If the bug changed while we were fetching it, we may have
+            # the old version. We check again after caching it, because
+            # forget() could be evicting it at the same time.
+            if in_flight.current(keys, generation):
+                bug_cache.put(keys, bug)
+                if not in_flight.current(keys, generation):
+                    bug_cache.evict(keys[0])
+        self.plugin.attachIndex.noteAttachments(self.name.lower(), attach_ids)
+        return self._matchRecords(ids, fetched, found)
+
+    def _staleRecords(self, ids, found):
+        """When Bugzilla isn't responding, puts the most recent copy we
+        have of each bug into found, marked as stale."""
+        bug_mirror = self.plugin.bugMirror
+        for id in ids:
+            bug = self.plugin.bugCache.get(self._cacheKey(id), stale=True)
+            if bug is None and bug_mirror:
+                bug = bug_mirror.get(self.name.lower(), id, (), None)
+            if bug is None:
+                bug = records.BugRecord(id, 'Unavailable')
+            found[id] = bug.staleCopy()
+
+    def _matchRecords(self, ids, bugs, found):
+        """Puts each of the bugs into found, under the id that was used
+        to ask for it. Returns the bugs we couldn't match to any id."""
+        by_id = {}
+        for bug in bugs:
+            for bug_id in bug.ids():
+                by_id[bug_id.lower()] = bug
+        used = set()
+        for wanted in ids:
+            bug = by_id.get(wanted.lower())
+            if bug is not None:
+                found[wanted] = bug
+                used.add(id(bug))
+        return [bug for bug in bugs if id(bug) not in used]
+
+    def prefetch(self, mail):
+        """Starts fetching the bugs that a bugmail is about in the
+        background, if any channel is going to announce it, so that they're
+        ready (or on their way) by the time the bugmail is handled."""
+        announced = False
+        for irc in world.ircs:
+            for channel in irc.state.channels.keys():
+                if self._shouldAnnounceBugInChannel(mail, channel):
+                    announced = True
+        if not announced:
+            return
+        ids = [mail.bug_id]
+        if mail.dupe_of:
+            ids.append(mail.dupe_of)
+        def failed():
+            self.plugin.log.debug('Could not prefetch bugs %r: %s' \
+                                  % (ids, sys.exc_info()[1]))
+        self.plugin.prefetcher.submit(
+            lambda: self._getBugRecords(ids, attachments=True),
+            lambda bugs: None, failed)
+
+    def noteBugmail(self, mail):
+        """Updates everything we remember about the bug that this bugmail
+        is about."""
+        self.forget([mail.bug_id, mail.dupe_of])
+        attachments = [(diff['attachment'], mail.bug_id)
+                       for diff in mail.diffs() if 'attachment' in diff]
+        if mail.attach_id:
+            attachments.append((mail.attach_id, mail.bug_id))
+        self.plugin.attachIndex.noteAttachments(self.name.lower(),
+                                                attachments)
+        if self.plugin.bugMirror:
+            try:
+                self.plugin.bugMirror.update(self.name.lower(), mail.bug_id,
+                                             mail.bugFields())
+            except:
+                self.plugin.log.exception(\
+                    'Exception while mirroring bug %s:' % mail.bug_id)
+
+    def revalidate(self):
+        """Checks whether the bugs we have cached for this installation
+        have changed, asking Bugzilla only for when they last changed, for
+        many bugs at once. Only the bugs that have changed get fetched
+        again, and the rest stay in the cache longer."""
+        install = self.name.lower()
+        cached  = {}
+        for key, bug in self.plugin.bugCache.items():
+            if key[0] == install and not bug.error and bug.get('delta_ts'):
+                cached[bug.bug_id] = bug
+        if not cached:
+            return
+
+        changed = []
+        chunk_size = self.plugin.registryValue('http.chunkSize')
+        for chunk in _chunkIds(cached.keys(), chunk_size):
+            times = self.backend.changeTimes(chunk)
+            for bug_id in chunk:
+                stamp = times.get(bug_id)
+                if stamp and records.sameTime(stamp,
+                                              cached[bug_id]['delta_ts']):
+                    self.plugin.bugCache.refresh(self._cacheKey(bug_id))
+                else:
+                    changed.append(bug_id)
+        self.plugin.log.debug('Revalidated %d bugs on %s, %d changed: %r'
+                              % (len(cached), self.name, len(changed),
+                                 changed))
+        if changed:
+            self.forget(changed)
+            self._getBugRecords(changed)
+
+    def forget(self, bug_ids):
+        """Drops the listed bugs from the plugin's cache, because we know
+        that they've changed."""
+        for bug_id in bug_ids:
+            if bug_id:
+                # Fetches that are already on their way don't get cached.
+                self.plugin.inFlight.changed(self._cacheKey(bug_id))
+                self.plugin.bugCache.evict(self._cacheKey(bug_id))
+                self.plugin.missingBugs.evict(self._cacheKey(bug_id))
 
     def _bugError(self, bug, bug_url):
-        error_type = bug.getAttribute('error')
+        error_type = bug.error
         if error_type == 'NotFound':
             return 'Bug %s was not found.' % bug_url
         elif error_type == 'NotPermitted':
             return 'Bug %s is not accessible.' % bug_url
+        elif error_type == 'Unavailable':
+            return 'Bug %s could not be retrieved: %s is not responding.' \
+                   % (bug_url, self.url)
         return 'Bug %s could not be retrieved: %s' % (bug_url,  error_type)
 
 ##########
@@ -690,23 +1029,256 @@ class Bugzilla(callbacks.PluginRegexp):
     def __init__(self, irc):
         self.__parent = super(Bugzilla, self)
         self.__parent.__init__(irc)
+        # The pool forks the bot, so we start it before any threads of
+        # ours, whose locks the processes would inherit.
+        self.parserPool = None
+        processes = self.registryValue('parsing.processes')
+        if processes:
+            self.parserPool = multiprocessing.Pool(processes)
         self.saidBugs = ircutils.IrcDict()
         self.saidAttachments = ircutils.IrcDict()
         sayTimeout = self.registryValue('bugSnarferTimeout')
         for k in irc.state.channels.keys():
             self.saidBugs[k] = TimeoutQueue(sayTimeout)
             self.saidAttachments[k] = TimeoutQueue(sayTimeout)
-        period = self.registryValue('mboxPollTimeout')
-        schedule.addPeriodicEvent(self._pollMbox, period, name=self.name(),
-                                  now=False)
+        self.bugCache = cache.BugCache(self.registryValue('cache.size'),
+                                       self.registryValue('cache.timeout'))
+        self.missingBugs = cache.BugCache(self.registryValue('cache.size'),
+                                self.registryValue('cache.negativeTimeout'))
+        self.inFlight = cache.SingleFlight()
+        self.revalidating = False
+        self.seenMail = cache.BugCache(SEEN_MAIL_SIZE,
+                                       self.registryValue('duplicateWindow'))
+        self.prefetcher = None
+        if self.registryValue('prefetch'):
+            self.prefetcher = engine.IOEngine(
+                self.registryValue('http.workers'), self.log)
+        self.ioEngine = None
+        if self.registryValue('engine.enabled'):
+            self.ioEngine = engine.IOEngine(
+                self.registryValue('engine.workers'), self.log)
+        self.sessions = {}
+        self.breakers = {}
+        self.sessionsLock = threading.Lock()
+        self.bugMirror = None
+        mirror_file = self.registryValue('mirror.database')
+        if mirror_file:
+            mirror_file = conf.supybot.directories.data.dirize(mirror_file)
+            self.bugMirror = mirror.BugMirror(mirror_file)
+        self.coalescing = {}
+        self.coalesceLock = threading.Lock()
+        self.coalesceCount = itertools.count()
+        # Coalesced bugmail that's due, for the work queue's thread.
+        self.dueFlushes = deque()
+        self.workQueue = None
+        self.queueStopped = False
+        self.queueReady = threading.Event()
+        queue_file = self.registryValue('queue.database')
+        if queue_file:
+            queue_file = conf.supybot.directories.data.dirize(queue_file)
+            self.workQueue = workqueue.WorkQueue(queue_file)
+        # The mirror keeps its attachment index in its database.
+        self.attachIndex = self.bugMirror or mirror.AttachmentIndex()
+        self.mboxReader = None
+        self.maildirReader = None
+        self.maildirWatcher = None
+        # Held while we read mail, so that die() can wait for it.
+        self.ingestLock = threading.RLock()
+        self.stopped = False
+        self.unloading = False
+        self.listener = None
+        port = self.registryValue('listener.port')
+        if port:
+            self.listener = mailsource.SmtpListener(
+                (self.registryValue('listener.address'), port),
+                self.registryValue('listener.queueSize'))
+            self.listener.start()
+            self.drainer = threading.Thread(target=self._drainListener,
+                                            name='Bugzilla bugmail announcer')
+            self.drainer.setDaemon(True)
+            self.drainer.start()
+        maildir = self.registryValue('maildir')
+        if maildir:
+            self._startMaildir(maildir)
+        else:
+            period = self.registryValue('mboxPollTimeout')
+            schedule.addPeriodicEvent(self._pollMbox, period,
+                                      name=self.name(), now=False)
+        period = self.registryValue('cache.revalidateInterval')
+        if period:
+            schedule.addPeriodicEvent(self._revalidate, period,
+                                      name=self.revalidateName(), now=False)
         for name in self.registryValue('bugzillas'):
             registerBugzilla(name)
+        if self.workQueue:
+            # Announce anything left over from before a restart.
+            self.queueReady.set()
+            self.announcer = threading.Thread(target=self._announceQueued,
+                                              name='Bugzilla work queue')
+            self.announcer.setDaemon(True)
+            self.announcer.start()
         reload(sys)
         sys.setdefaultencoding('utf-8')
 
     def die(self):
         self.__parent.die()
-        schedule.removeEvent(self.name())
+        # Stop reading mail, and wait for whatever we're reading now to be
+        # dealt with. Without a work queue, that means we stop announcing
+        # it, because that can take a long time, and somebody is waiting
+        # for us to unload. What we haven't announced is read again once
+        # we're loaded, unless it came from the SMTP listener.
+        self.unloading = True
+        try:
+            schedule.removeEvent(self.name())
+        except KeyError:
+            pass
+        if self.maildirWatcher:
+            self.maildirWatcher.stop()
+        if self.listener:
+            # Mail that we've accepted still has to be dealt with.
+            self.listener.stop()
+            self.drainer.join(LISTENER_DRAIN_TIMEOUT)
+        self.ingestLock.acquire()
+        try:
+            # Announce whatever we were holding on to for coalescing,
+            # unless it's safe in the work queue.
+            for key, entry in self.coalescing.items():
+                self._cancelFlush(entry)
+                if not self.workQueue:
+                    self._flushCoalesced(key, entry)
+            self.stopped = True
+            # A maildir poll that was running when we started may have
+            # rescheduled itself since.
+            try:
+                schedule.removeEvent(self.name())
+            except KeyError:
+                pass
+        finally:
+            self.ingestLock.release()
+        if self.parserPool:
+            self.parserPool.terminate()
+        try:
+            schedule.removeEvent(self.revalidateName())
+        except KeyError:
+            pass
+        if self.ioEngine:
+            self.ioEngine.stop()
+        if self.prefetcher:
+            self.prefetcher.stop()
+        for session in self.sessions.values():
+            session.close()
+        for name in self.breakers.keys():
+            try:
+                schedule.removeEvent(self.probeName(name))
+            except KeyError:
+                pass
+        if self.bugMirror:
+            self.bugMirror.close()
+        if self.workQueue:
+            self.queueStopped = True
+            self.queueReady.set()
+            # Anything that isn't acknowledged by now will be announced
+            # after we're loaded again.
+            self.announcer.join(5)
+            self.workQueue.close()
+
+    def wantedFields(self):
+        """Returns the set of bug fields and the set of attachment fields
+        that any channel could want us to display."""
+        bug_fields    = set(self.registryValue('bugFormat'))
+        attach_fields = set(self.registryValue('attachFormat'))
+        for irc in world.ircs:
+            for channel in irc.state.channels.keys():
+                bug_fields.update(self.registryValue('bugFormat', channel))
+                attach_fields.update(self.registryValue('attachFormat',
+                                                        channel))
+        # bug_status is displayed along with the resolution.
+        bug_fields.add('resolution')
+        # We need to know when bugs changed, to revalidate them.
+        bug_fields.add('delta_ts')
+        return bug_fields, attach_fields
+
+    def breaker(self, name):
+        """Returns the CircuitBreaker for the named installation."""
+        name = name.lower()
+        self.sessionsLock.acquire()
+        try:
+            if name not in self.breakers:
+                self.breakers[name] = engine.CircuitBreaker(
+                    self.registryValue('http.breakerThreshold'))
+            return self.breakers[name]
+        finally:
+            self.sessionsLock.release()
+
+    def revalidateName(self):
+        return '%s revalidate' % self.name()
+
+    def _revalidate(self):
+        # This is a scheduled event, so it runs on the bot's main loop, and
+        # revalidating takes a request for every chunk of the cache.
+        if self.revalidating:
+            return
+        self.revalidating = True
+        self._inBackground(self._revalidateAll, 'revalidating')
+
+    def _inBackground(self, function, doing):
+        """Calls function off the bot's main loop: on the I/O engine or the
+        prefetcher if either is running, or else on a thread of its own.
+        doing describes what function does, for the log."""
+        io_engine = self.ioEngine or self.prefetcher
+        if io_engine:
+            io_engine.submit(function, lambda result: None,
+                lambda: self.log.exception('Exception while %s:' % doing))
+            return
+        def run():
+            try:
+                function()
+            except:
+                self.log.exception('Exception while %s:' % doing)
+        thread = threading.Thread(target=run, name='Bugzilla %s' % doing)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _revalidateAll(self):
+        try:
+            for name in self.registryValue('bugzillas'):
+                if self.stopped:
+                    return
+                if not self.breaker(name).allow():
+                    self.log.debug('Not revalidating bugs on %s, because it '
+                                   'is not responding.' % name)
+                    continue
+                try:
+                    BugzillaInstall(self, name).revalidate()
+                except:
+                    self.log.exception('Exception while revalidating bugs '
+                                       'on %s:' % name)
+        finally:
+            self.revalidating = False
+
+    def probeName(self, name):
+        return '%s probe %s' % (self.name(), name.lower())
+
+    def httpSession(self, name):
+        """Returns the requests.Session that all HTTP traffic to the named
+        installation goes through, so that connections get re-used."""
+        name = name.lower()
+        self.sessionsLock.acquire()
+        try:
+            if name not in self.sessions:
+                pool_size = self.registryValue('http.poolSize')
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(utils.web.defaultHeaders)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                session.headers['Connection'] = 'keep-alive'
+                self.sessions[name] = session
+            return self.sessions[name]
+        finally:
+            self.sessionsLock.release()
 
     def add(self, irc, msg, args, name, url):
         """<name> <url>
@@ -731,23 +1303,39 @@ class Bugzilla(callbacks.PluginRegexp):
 
         channel = msg.args[0]
         installation = self._defaultBz(channel)
-        lines = installation.getAttachments(attach_ids, channel)
-        for l in lines: irc.reply(l)
+        self._reply(irc, lambda: installation.getAttachments(attach_ids,
+                                                             channel))
     attachment = wrap(attachment, [many(('id','attachment'))])
 
     def bug(self, irc, msg, args, bug_id_string):
         """<bug_id> [<bug_ids>]
         Reports the details of the bugs with the listed ids to this channel.
         Accepts bug aliases as well as numeric ids. Your list can be separated
-        by spaces, commas, and the word "and" if you want."""
+        by spaces, commas, and the word "and" if you want. You can also ask
+        for a range of bugs, like 1000-1050."""
 
         channel = msg.args[0]
-        bug_ids = re.split('[!?.,\(\)\s]|[\b\W]and[\b\W]*|\bbug\b', 
-                           bug_id_string)
+        words = re.split('[!?.,\(\)\s]|[\b\W]and[\b\W]*|\bbug\b', 
+                         bug_id_string)
+        bug_ids = []
+        range_limit = self.registryValue('bugRangeLimit', channel)
+        for word in words:
+            rangeMatch = re.match('(\d+)-(\d+)$', word)
+            if not rangeMatch:
+                bug_ids.append(word)
+                continue
+            start, end = int(rangeMatch.group(1)), int(rangeMatch.group(2))
+            if end < start:
+                irc.error('Bug ranges go from the lower id to the higher '
+                          'one, like %d-%d.' % (end, start))
+                return
+            if end - start >= range_limit:
+                irc.error('Bug ranges can contain at most %d bugs.' \
+                          % range_limit)
+                return
+            bug_ids.extend([str(id) for id in range(start, end + 1)])
         installation = self._defaultBz(channel)
-        bug_strings = installation.getBugs(bug_ids, channel)
-        for s in bug_strings:
-            irc.reply(s)
+        self._reply(irc, lambda: installation.getBugs(bug_ids, channel))
     bug = wrap(bug, ['text'])
 
     def query(self, irc, msg, args, options, query_string):
@@ -775,8 +1363,8 @@ class Bugzilla(callbacks.PluginRegexp):
                     return
         
         limit = self.registryValue('queryResultLimit', channel)
-        strings = installation.query(query_string, total, channel, limit)
-        for s in strings: irc.reply(s)
+        self._reply(irc, lambda: installation.query(query_string, total,
+                                                    channel, limit))
         
     query = wrap(query, [getopts({'total' : '', 'install' : 'something'}), 'text'])
 
@@ -803,12 +1391,10 @@ class Bugzilla(callbacks.PluginRegexp):
         self.log.debug('Install: %r' % match.group('install'))
         installation = self._bzOrDefault(match.group('install'), channel)
         if type.lower() == 'bug': 
-            strings = installation.getBugs(ids, channel)
+            lookup = lambda: installation.getBugs(ids, channel)
         else: 
-            strings = installation.getAttachments(ids, channel)
-
-        for s in strings:
-            irc.reply(s, prefixNick=False)
+            lookup = lambda: installation.getAttachments(ids, channel)
+        self._reply(irc, lookup, prefixNick=False)
 
     def snarfBugUrl(self, irc, msg, match):
         r"(?P<url>https?://\S+/)show_bug.cgi\?id=(?P<bug>\w+)"
@@ -823,10 +1409,30 @@ class Bugzilla(callbacks.PluginRegexp):
         except BugzillaNotFound:
             self.log.debug('Ignoring unknown Bugzilla: ' + url)
             return
-        bug_strings = installation.getBugs(bug_ids, channel, show_url=False)
-        for s in bug_strings:
-            irc.reply(s, prefixNick=False)
+        self._reply(irc, lambda: installation.getBugs(bug_ids, channel,
+                                                      show_url=False),
+                    prefixNick=False)
     
+    def _reply(self, irc, lookup, **kwargs):
+        """Calls lookup, which talks to Bugzilla and returns a list of
+        lines, and replies with each of the lines. If the I/O engine is
+        on, this happens on one of its threads, and we return right away."""
+        def reply(lines):
+            for line in lines: irc.reply(line, **kwargs)
+        if self.ioEngine is None:
+            reply(lookup())
+        else:
+            self.ioEngine.submit(lookup, reply,
+                                 lambda: self._lookupFailed(irc))
+
+    def _lookupFailed(self, irc):
+        e = sys.exc_info()[1]
+        if isinstance(e, (callbacks.Error, utils.web.Error)):
+            irc.error(str(e))
+        else:
+            self.log.exception('Exception while talking to Bugzilla:')
+            irc.error('Something went wrong while talking to Bugzilla.')
+
     def _bzOrDefault(self, name, channel):
         if name is None:
             return self._defaultBz(channel)
@@ -890,44 +1496,422 @@ class Bugzilla(callbacks.PluginRegexp):
         return True
 
     def _pollMbox(self):
-#        return
-#    
-#    def poll(self, irc, msg, args):
         file_name = self.registryValue('mbox')
         if not file_name: return
-        boxFile = open(file_name, 'r+b')
-        _lock_file(boxFile)
-        self.log.debug('Polling mbox %r' % boxFile)
-
+        self.ingestLock.acquire()
+        try:
+            if self.stopped: return
+            reader = self._mboxReader(file_name)
+            self.log.debug('Polling mbox %r' % file_name)
+            try:
+                messages = reader.read()
+            except mailsource.LockBusy, e:
+                # We'll get to it on the next poll.
+                self.log.debug('Skipping this poll: %s' % e)
+                return
+            self._ingestMessages(messages, reader.done)
+        finally:
+            self.ingestLock.release()
+
+    def _mboxReader(self, file_name):
+        if self.mboxReader is None or self.mboxReader.path != file_name:
+            state = conf.supybot.directories.data.dirize('Bugzilla.mbox')
+            self.mboxReader = mailsource.MboxReader(file_name, state,
+                self.registryValue('mboxCompactSize'))
+        return self.mboxReader
+
+    def _pollMaildir(self):
+        """Reads everything in the Maildir. Returns whether there was
+        anything there."""
+        self.log.debug('Polling maildir %r' % self.maildirReader.path)
+        return self._ingestMessages(self.maildirReader.read(),
+                                    self.maildirReader.done)
+
+    def _pollMaildirAdaptively(self):
+        """Without inotify, we poll the Maildir often while mail is
+        arriving, and back off to mboxPollTimeout when it isn't."""
+        found = False
+        try:
+            found = self._pollMaildir()
+        finally:
+            if found:
+                self.maildirInterval = MIN_POLL_INTERVAL
+            else:
+                self.maildirInterval = min(self.maildirInterval * 2,
+                    self.registryValue('mboxPollTimeout'))
+            # die() sets stopped under the same lock, so we can't put
+            # ourselves back on the schedule once it has cleared it.
+            self.ingestLock.acquire()
+            try:
+                if not self.stopped:
+                    schedule.addEvent(self._pollMaildirAdaptively,
+                                      time() + self.maildirInterval,
+                                      name=self.name())
+            finally:
+                self.ingestLock.release()
+
+    def _maildirChanged(self):
+        # Called from the inotify thread, which mustn't die.
+        try:
+            self._pollMaildir()
+        except:
+            self.log.exception('Exception while polling the maildir:')
+
+    def _startMaildir(self, path):
+        self.maildirReader = mailsource.MaildirReader(path)
+        self.maildirWatcher = self.maildirReader.watch(self._maildirChanged)
+        if self.maildirWatcher:
+            # Pick up whatever arrived while we weren't watching.
+            schedule.addEvent(self._pollMaildir, time(), name=self.name())
+        else:
+            self.log.info('pyinotify is not installed, so we will poll '
+                          'the maildir %r.' % path)
+            self.maildirInterval = MIN_POLL_INTERVAL
+            schedule.addEvent(self._pollMaildirAdaptively, time(),
+                              name=self.name())
+
+    def _drainListener(self):
+        """Runs on its own thread, announcing mail from the SMTP listener
+        as it arrives."""
+        while True:
+            texts = self.listener.take()
+            if texts is None:
+                return
+            if self.unloading and not self.workQueue:
+                self.log.warning('Dropping %d bugmails from the SMTP '
+                                 'listener, because we are being unloaded.'
+                                 % len(texts))
+                continue
+            try:
+                self._ingestMessages([(None, text) for text in texts])
+            except:
+                self.log.exception('Exception while handling mail from '
+                                   'the SMTP listener:')
+
+    def _ingestMessages(self, messages, done=None):
+        """Parses and announces each message in messages, an iterable of
+        (token, text) tuples, one at a time, so that each bugmail can be
+        freed once it's been announced. Calls done(token) once a message
+        is safe in the work queue (or has been announced, if there's no
+        work queue), or turns out to be mail that we don't announce.
+        Returns whether there were any messages."""
+        if done is None:
+            done = lambda token: None
+        self.ingestLock.acquire()
         try:
-            box = mailbox.PortableUnixMailbox(boxFile, _message_factory)
-            bugmails = []
-            for message in box:
-                if message == '': continue
-                self.log.debug('Parsing message %s' % message['Message-ID'])
+            if self.stopped:
+                return False
+            found = [False]
+            def read():
+                for message in messages:
+                    found[0] = True
+                    yield message
+            wanted = self._prefilter(read(), done)
+            parsed = self._parseMessages(self._unseen(wanted, done))
+            routed = self._routeBugmails(parsed, done)
+            if self.workQueue:
+                for token, mail in routed:
+                    self.workQueue.put(mail)
+                    done(token)
+                    self.queueReady.set()
+                return found[0]
+            lookahead = self.registryValue('bugmailLookahead')
+            for token, mail in _lookahead(routed, lookahead):
+                if self.unloading:
+                    break
+                self._announceBugmail(mail)
+                done(token)
+            return found[0]
+        finally:
+            self.ingestLock.release()
+
+    def _announceQueued(self):
+        """Runs on its own thread, announcing the bugmail in the work queue
+        in order, and acknowledging each one once it's been announced."""
+        # Bugmail that's being coalesced stays in the queue, but we've
+        # taken it.
+        taken = 0
+        while not self.queueStopped:
+            self.queueReady.wait(self.registryValue('mboxPollTimeout'))
+            self.queueReady.clear()
+            while not self.queueStopped:
                 try:
-                    bugmails.append(bugmail.Bugmail(message))
-                except bugmail.NotBugmailException:
-                    continue
+                    self._flushDue()
+                    pending = self.workQueue.pending(QUEUE_BATCH_SIZE, taken)
+                    if not pending:
+                        break
+                    for queue_id, mail in pending:
+                        if self.queueStopped:
+                            return
+                        taken = queue_id
+                        if mail is None:
+                            self.log.warning('Dropping a queued bugmail '
+                                             'that we can no longer read.')
+                            self.workQueue.ack(queue_id)
+                        else:
+                            self._announceBugmail(mail, queue_id)
                 except:
-                    self.log.exception('Exception while parsing message:')
-                    self.log.debug("Message:\n%s" % message.as_string())
-            boxFile.truncate(0)
+                    self.log.exception('Exception while reading the work '
+                                       'queue:')
+                    break
+
+    def _announceBugmail(self, mail, queue_id=None):
+        """Announces a bugmail, unless coalesceWindow is set. Then, we hold
+        on to it for that long, and fold any later bugmail about the same
+        bug from the same person into it, before announcing it."""
+        window = self.registryValue('coalesceWindow')
+        if not window:
+            self._finishBugmail(mail, [queue_id])
+            return
+        key = (mail.urlbase, mail.bug_id)
+        self.coalesceLock.acquire()
+        try:
+            held = self.coalescing.get(key)
+            if held and held[0].canMerge(mail):
+                held[0].merge(mail)
+                held[1].append(queue_id)
+                return
+            # The bugmail, its queue ids, and the name of the event that
+            # announces it.
+            entry = [mail, [queue_id], '%s coalesce %s'
+                     % (self.name(), self.coalesceCount.next())]
+            self.coalescing[key] = entry
         finally:
-            _unlock_file(boxFile)
-            boxFile.close()
+            self.coalesceLock.release()
+        # Something we can't merge with comes after what we were holding.
+        if held:
+            self._cancelFlush(held)
+            self._finishBugmail(held[0], held[1])
+        schedule.addEvent(lambda: self._flushLater(key, entry),
+                          time() + window, name=entry[2])
+
+    def _cancelFlush(self, entry):
+        try:
+            schedule.removeEvent(entry[2])
+        except KeyError:
+            pass
+
+    def _flushLater(self, key, entry):
+        # Announcing means fetching the bug, and scheduled events run on
+        # the bot's main loop, so the announcer thread does it, if there
+        # is one.
+        if self.workQueue:
+            self.dueFlushes.append((key, entry))
+            self.queueReady.set()
+        else:
+            self._inBackground(lambda: self._flushCoalesced(key, entry),
+                               'announcing coalesced bugmail')
 
-        self._handleBugmails(bugmails)
-    
-    def _handleBugmails(self, bugmails):
-        for mail in bugmails:
+    def _flushDue(self):
+        while self.dueFlushes:
+            key, entry = self.dueFlushes.popleft()
+            self._flushCoalesced(key, entry)
+
+    def _flushCoalesced(self, key, entry):
+        self.coalesceLock.acquire()
+        try:
+            if self.stopped or self.coalescing.get(key) is not entry:
+                return
+            del self.coalescing[key]
+        finally:
+            self.coalesceLock.release()
+        self._finishBugmail(entry[0], entry[1])
+
+    def _finishBugmail(self, mail, queue_ids):
+        self._handleBugmail(mail)
+        if self.workQueue:
+            for queue_id in queue_ids:
+                if queue_id is not None:
+                    self.workQueue.ack(queue_id)
+
+    def _routeBugmails(self, results, done):
+        """Takes the results of _parseMessages and yields (token, bugmail)
+        for each bugmail, once we've noted it (and started fetching its
+        bugs)."""
+        for token, mail, error in results:
+            if error:
+                self.log.error('Exception while parsing message:\n%s'
+                               % error)
+            if mail:
+                self._ingestBugmail(mail)
+                yield token, mail
+            else:
+                done(token)
+
+    def _prefilter(self, messages, done):
+        """Yields the (token, text) tuples in messages that might be
+        bugmail that we'd announce, looking only at their raw headers and
+        the start of their bodies."""
+        products = self._watchedProducts()
+        for token, text in messages:
+            headers, body = bugmail.rawParts(text)
+            product = bugmail.rawHeader(headers, 'X-Bugzilla-Product')
+            if not product or bugmail.isDependencyNotice(headers, body):
+                done(token)
+                continue
+            # If the bug just moved out of a watched product, we still
+            # announce it.
+            if (products is not None and product not in products
+                and not bugmail.PRODUCT_CHANGE.search(body)):
+                self._forgetUnwatched(headers)
+                done(token)
+                continue
+            yield token, text
+
+    def _watchedProducts(self):
+        """Returns the set of products that some channel watches, or None
+        if some channel watches anything other than products, so that we
+        can't tell whether we'll announce bugmail from its product."""
+        products = set()
+        for name in self.registryValue('bugzillas'):
+            watched = 'bugzillas.%s.watchedItems.' % name
+            for irc in world.ircs:
+                for channel in irc.state.channels.keys():
+                    if (self.registryValue(watched + 'all', channel)
+                        or self.registryValue(watched + 'component', channel)
+                        or self.registryValue(watched + 'changer', channel)):
+                        return None
+                    products.update(self.registryValue(watched + 'product',
+                                                       channel))
+        return products
+
+    def _forgetUnwatched(self, headers):
+        """We don't parse bugmail about products that nobody watches, but
+        the bug it's about has still changed."""
+        try:
+            bug = bugmail.rawBug(headers)
+            if not bug:
+                return
+            urlbase, bug_id = bug
             try:
-                installation = self._bzByUrl(mail.urlbase)
+                installation = self._bzByUrl(urlbase)
             except BugzillaNotFound:
                 installation = self._defaultBz()
+            installation.forget([bug_id])
+            if self.bugMirror:
+                self.bugMirror.forget(installation.name.lower(), bug_id)
+        except:
+            self.log.exception('Exception while forgetting an unwatched '
+                               'bug:')
+
+    def _unseen(self, messages, done):
+        """Yields the (token, text) tuples in messages that we haven't
+        recently seen another copy of, without parsing their bodies."""
+        for token, text in messages:
+            if self.seenMail.timeout:
+                keys = bugmail.messageKeys(text)
+                if [key for key in keys if self.seenMail.get(key)]:
+                    self.log.debug('Skipping another copy of a bugmail.')
+                    done(token)
+                    continue
+                for key in keys:
+                    self.seenMail.put([key], True)
+            yield token, text
+
+    def _parseMessages(self, messages):
+        """Yields (token, bugmail, error) for each (token, text) tuple in
+        messages, in order."""
+        # _parseTexts reads a batch of messages ahead of what it yields.
+        tokens = deque()
+        def texts():
+            for token, text in messages:
+                tokens.append(token)
+                yield text
+        for mail, error in self._parseTexts(texts()):
+            yield tokens.popleft(), mail, error
+
+    def _parseTexts(self, texts):
+        """Yields (bugmail, error) for each message in texts, in order. See
+        bugmail.parseText. Big messages, and big backlogs of messages, are
+        parsed in the parsing processes."""
+        texts = iter(texts)
+        if not self.parserPool:
+            for text in texts:
+                yield bugmail.parseText(text)
+            return
+
+        backlog = self.registryValue('parsing.backlog')
+        batch = list(itertools.islice(texts, backlog))
+        if len(batch) == backlog:
+            self.log.debug('Parsing a backlog of bugmail in %s processes.'
+                           % self.registryValue('parsing.processes'))
+            # The pool only ever gets a list of one batch at a time, so that
+            # texts is always read on our thread, and parsed bugmail doesn't
+            # pile up faster than we announce it.
+            while batch:
+                parsed = None
+                if self.parserPool:
+                    pending = self.parserPool.map_async(bugmail.parseText,
+                                                        batch,
+                                                        PARSE_CHUNK_SIZE)
+                    parsed = self._pooled(lambda: pending.get(PARSE_TIMEOUT))
+                if parsed is None:
+                    parsed = [bugmail.parseText(text) for text in batch]
+                for result in parsed:
+                    yield result
+                batch = list(itertools.islice(texts, backlog))
+            return
+
+        size = self.registryValue('parsing.messageSize')
+        results = []
+        for text in batch:
+            if len(text) >= size:
+                results.append((self.parserPool.apply_async(
+                    bugmail.parseText, (text,)), text))
+            else:
+                results.append((None, text))
+        for result, text in results:
+            parsed = None
+            if result is not None:
+                parsed = self._pooled(lambda: result.get(PARSE_TIMEOUT))
+            if parsed is None:
+                parsed = bugmail.parseText(text)
+            yield parsed
+
+    def _pooled(self, get):
+        """Returns get(), which waits for the parsing processes' results.
+        If they don't come up with them in time, returns None, and we stop
+        using the processes: the caller has to parse the messages
+        itself."""
+        if not self.parserPool:
+            return None
+        try:
+            return get()
+        except multiprocessing.TimeoutError:
+            self.log.warning('The parsing processes are stuck, so we will '
+                             'parse bugmail ourselves from now on.')
+            self.parserPool.terminate()
+            self.parserPool = None
+            return None
+
+    def _ingestBugmail(self, mail):
+        """Called as soon as a bugmail has been parsed, before it's handled.
+        Updates what we remember about the bug, and starts fetching it in
+        the background if it's going to be announced."""
+        try:
+            installation = self._bzForBugmail(mail)
+            installation.noteBugmail(mail)
+            if self.prefetcher:
+                installation.prefetch(mail)
+        except:
+            self.log.exception('Exception while ingesting mail for bug %s:'
+                               % mail.bug_id)
+
+    def _handleBugmail(self, mail):
+        try:
+            installation = self._bzForBugmail(mail)
             self.log.debug('Handling bugmail for bug %s on %s (%s)' \
                            % (mail.bug_id, mail.urlbase, installation.name))
             installation.handleBugmail(mail)
+        except:
+            self.log.exception('Exception while handling mail for bug %s:'
+                               % mail.bug_id)
+
+    def _bzForBugmail(self, mail):
+        try:
+            return self._bzByUrl(mail.urlbase)
+        except BugzillaNotFound:
+            return self._defaultBz()
 
 Class = Bugzilla
 
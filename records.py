@@ -0,0 +1,277 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+###
+
+import re
+import csv
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+'''Fields that every record has, no matter which fields were asked for,
+   because we need them to tell which bug a record is about.'''
+ID_FIELDS = ('bug_id', 'alias')
+
+'''The buglist.cgi columns that we can ask for, by the name of the same
+   field in show_bug.cgi XML. Anything else only comes in the XML.'''
+CSV_COLUMNS = {
+    'bug_id'            : 'bug_id',
+    'alias'             : 'alias',
+    'short_desc'        : 'short_desc',
+    'bug_status'        : 'bug_status',
+    'resolution'        : 'resolution',
+    'bug_severity'      : 'bug_severity',
+    'priority'          : 'priority',
+    'assigned_to'       : 'assigned_to',
+    'qa_contact'        : 'qa_contact',
+    'reporter'          : 'reporter',
+    'product'           : 'product',
+    'component'         : 'component',
+    'classification'    : 'classification',
+    'version'           : 'version',
+    'target_milestone'  : 'target_milestone',
+    'op_sys'            : 'op_sys',
+    'rep_platform'      : 'rep_platform',
+    'keywords'          : 'keywords',
+    'status_whiteboard' : 'status_whiteboard',
+    'bug_file_loc'      : 'bug_file_loc',
+    'votes'             : 'votes',
+    'delta_ts'          : 'changeddate',
+    'creation_ts'       : 'opendate',
+}
+FROM_CSV = dict([(column, field) for field, column in CSV_COLUMNS.items()])
+
+'''The names that the REST API (Bugzilla 5 and up) uses for bug fields,
+   by the name of the same field in show_bug.cgi XML. Fields that are the
+   same in both aren't listed.'''
+REST_FIELDS = {
+    'bug_id'            : 'id',
+    'short_desc'        : 'summary',
+    'bug_status'        : 'status',
+    'bug_severity'      : 'severity',
+    'rep_platform'      : 'platform',
+    'bug_file_loc'      : 'url',
+    'status_whiteboard' : 'whiteboard',
+    'reporter'          : 'creator',
+    'creation_ts'       : 'creation_time',
+    'delta_ts'          : 'last_change_time',
+    'dependson'         : 'depends_on',
+    'blocked'           : 'blocks',
+}
+FROM_REST = dict([(rest, field) for field, rest in REST_FIELDS.items()])
+
+'''The same thing as REST_FIELDS, for attachments.'''
+REST_ATTACH_FIELDS = {
+    'attachid'   : 'id',
+    'desc'       : 'summary',
+    'filename'   : 'file_name',
+    'type'       : 'content_type',
+    'ispatch'    : 'is_patch',
+    'isobsolete' : 'is_obsolete',
+    'isprivate'  : 'is_private',
+    'attacher'   : 'creator',
+    'date'       : 'creation_time',
+    'delta_ts'   : 'last_change_time',
+}
+FROM_REST_ATTACH = dict([(rest, field)
+                         for field, rest in REST_ATTACH_FIELDS.items()])
+
+class BugRecord(dict):
+    """The fields of a single bug, keyed by the name they have in the
+    show_bug.cgi XML. Records are what we cache, so they hold plain
+    strings instead of DOM nodes.
+
+    A record may only hold some of a bug's fields. known and attach_known
+    are the sets of bug and attachment fields that it can answer for
+    (whether or not the bug actually has a value for them), or None if it
+    has all of them."""
+
+    def __init__(self, bug_id, error=None, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.bug_id = bug_id
+        self.error  = error
+        # None if we didn't fetch the attachments.
+        self.attachments  = []
+        self.known        = None
+        self.attach_known = None
+        # True if this might not be what Bugzilla would tell us right now.
+        self.stale        = False
+
+    def text(self, field):
+        """Returns the text of a field, the way we display it."""
+        text = self.get(field)
+        # Include Resolution in status
+        if text and field == 'bug_status' and self.get('resolution'):
+            text += ' ' + self['resolution']
+        return text
+
+    def ids(self):
+        """The ids that somebody could use to ask for this bug."""
+        keys = [self.bug_id]
+        if self.get('alias'):
+            keys.append(self['alias'])
+        return keys
+
+    def staleCopy(self):
+        """Returns a copy of this record that is marked as stale."""
+        copy = BugRecord(self.bug_id, self.error, self)
+        copy.attachments  = self.attachments
+        copy.known        = self.known
+        copy.attach_known = self.attach_known
+        copy.stale        = True
+        return copy
+
+    def covers(self, fields=None, attach_fields=None, attachments=False):
+        """Can this record answer for all of the listed fields (and for
+        the bug's attachments, if attachments is True)?"""
+        if attachments and self.attachments is None:
+            return False
+        if fields and self.known is not None:
+            for field in fields:
+                if field not in self.known: return False
+        if attach_fields and self.attach_known is not None:
+            for field in attach_fields:
+                if field not in self.attach_known: return False
+        return True
+
+def sameTime(stamp, other):
+    """Compares two last-changed times from Bugzilla, which may come in
+    slightly different formats (with or without seconds or a time zone,
+    for example). Returns True if they're the same time."""
+    stamp = re.sub('\D', '', stamp)[:14]
+    other = re.sub('\D', '', other)[:14]
+    length = min(len(stamp), len(other))
+    return length > 0 and stamp[:length] == other[:length]
+
+def parseXml(stream, fields=None, attach_fields=None):
+    """Reads the XML from show_bug.cgi out of a file-like object, a bit at
+    a time, and returns a BugRecord for each <bug> in it. Only the listed
+    fields of bugs and attachments are kept, or all of them if the list is
+    None. Throws SyntaxError if the XML is broken before the first bug."""
+    bugs = []
+    path = []
+    root = bug = attachment = None
+    try:
+        for event, elem in ElementTree.iterparse(stream, ('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                depth = len(path)
+                if depth == 1:
+                    root = elem
+                elif depth == 2 and elem.tag == 'bug':
+                    bug = BugRecord('', elem.get('error'))
+                    if fields is not None:
+                        bug.known = set(fields)
+                    if attach_fields is not None:
+                        bug.attach_known = set(attach_fields)
+                elif depth == 3 and elem.tag == 'attachment' and bug is not None:
+                    attachment = {'ispatch': elem.get('ispatch')}
+                continue
+
+            path.pop()
+            depth = len(path)
+            if bug is None:
+                pass
+            elif depth == 1 and elem.tag == 'bug':
+                bugs.append(bug)
+                bug = None
+                root.clear()
+            elif depth == 2 and elem.tag == 'attachment':
+                bug.attachments.append(attachment)
+                attachment = None
+            elif depth == 2:
+                tag = elem.tag
+                if tag == 'bug_id':
+                    bug.bug_id = elem.text or ''
+                # XXX This should probably support multiplicable fields
+                if (tag not in bug
+                    and (fields is None or tag in fields or tag in ID_FIELDS)):
+                    bug[tag] = elem.text or ''
+            elif depth == 3 and attachment is not None:
+                tag = elem.tag
+                if (tag not in attachment and (attach_fields is None
+                        or tag in attach_fields or tag == 'attachid')):
+                    attachment[tag] = elem.text or ''
+            # Long fields like <long_desc> have children, and we never
+            # want them.
+            if depth >= 2:
+                elem.clear()
+    except SyntaxError:
+        if not bugs: raise
+    return bugs
+
+def parseCsv(lines):
+    """Reads the CSV from buglist.cgi out of an iterable of lines, and
+    returns a BugRecord for each row. The first line names the columns,
+    and each record only knows about those columns."""
+    reader = csv.reader(lines)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return []
+    fields = [FROM_CSV.get(column, column) for column in header]
+    bugs = []
+    for row in reader:
+        if not row: continue
+        bug = BugRecord('', None, zip(fields, row))
+        bug.bug_id = bug.get('bug_id', '')
+        bug.known  = set(fields)
+        bugs.append(bug)
+    return bugs
+
+def _restText(value):
+    if isinstance(value, bool):
+        return value and '1' or '0'
+    if isinstance(value, list):
+        return ', '.join([_restText(item) for item in value])
+    if isinstance(value, dict):
+        # Users come back as objects, in some places.
+        return value.get('name', '')
+    if value is None:
+        return ''
+    return unicode(value)
+
+def fromJson(bug, fields=None):
+    """Makes a BugRecord out of a bug from the REST API."""
+    record = BugRecord(_restText(bug.get('id', '')))
+    for name, value in bug.items():
+        record[FROM_REST.get(name, name)] = _restText(value)
+    if fields is not None:
+        record.known = set(fields)
+    return record
+
+def attachmentFromJson(attachment):
+    """Turns an attachment from the REST API into the kind of dict that
+    BugRecord.attachments holds."""
+    return dict([(FROM_REST_ATTACH.get(name, name), _restText(value))
+                 for name, value in attachment.items()])
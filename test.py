@@ -5,13 +5,222 @@
 #
 ###
 
+import os
+import json
+import urlparse
+import tempfile
+import threading
+import BaseHTTPServer
+
 from supybot.test import *
 
+import plugin
+import bugmail
+
+BUGMAIL = """Subject: [Bug 123] New: Something broke
+Message-ID: <bug-123-5@https.bugzilla.example.com/>
+X-Bugzilla-Product: Foo
+X-Bugzilla-Component: Bar
+X-Bugzilla-Who: joe@example.com
+X-Bugzilla-Status: NEW
+X-Bugzilla-Severity: normal
+X-Bugzilla-Priority: P1
+X-Bugzilla-Assigned-To: nobody@example.com
+
+https://bugzilla.example.com/show_bug.cgi?id=123
+
+           Summary: Something broke
+           Product: Foo
+
+--- Comment #0 from joe ---
+It broke.
+
+-- 
+Configure bugmail
+"""
+
+CHANGE_MAIL = """Subject: [Bug 123] Something broke
+Message-ID: <bug-123-5-%(count)s@https.bugzilla.example.com/>
+In-Reply-To: <bug-123-5@https.bugzilla.example.com/>
+X-Bugzilla-Product: Foo
+X-Bugzilla-Component: Bar
+X-Bugzilla-Who: %(who)s
+X-Bugzilla-Status: %(status)s
+X-Bugzilla-Severity: normal
+X-Bugzilla-Priority: P1
+X-Bugzilla-Assigned-To: nobody@example.com
+
+https://bugzilla.example.com/show_bug.cgi?id=123
+
+%(who)s changed:
+
+%(rows)s
+
+-- 
+Configure bugmail
+"""
+
+def changeMail(rows, who='joe@example.com', status='NEW'):
+    """Returns a Bugmail in which who changed bug 123. rows is a list of
+    (what, removed, added) tuples for its table of changes."""
+    rows = [('What', 'Removed', 'Added')] + rows
+    table = '\n'.join(['%19s|%-28s|%s' % row for row in rows])
+    changeMail.count += 1
+    mail, error = bugmail.parseText(CHANGE_MAIL % {'count': changeMail.count,
+        'who': who, 'status': status, 'rows': table})
+    assert mail, error
+    return mail
+changeMail.count = 0
+
+class BugmailMergeTestCase(SupyTestCase):
+    def _diffs(self, mail):
+        return [(d['what'], d['removed'], d['added']) for d in mail.diffs()]
+
+    def testMergeStatusChain(self):
+        mail = changeMail([('Status', 'NEW', 'ASSIGNED')],
+                          status='ASSIGNED')
+        later = changeMail([('Status', 'ASSIGNED', 'RESOLVED'),
+                            ('Resolution', '---', 'FIXED')],
+                           status='RESOLVED')
+        self.failUnless(mail.canMerge(later))
+        mail.merge(later)
+        self.assertEqual(self._diffs(mail),
+                         [('Status', 'NEW', 'RESOLVED'),
+                          ('Resolution', '---', 'FIXED')])
+        self.assertEqual(mail.status, 'RESOLVED')
+
+    def testMergeDropsFieldThatChangedBack(self):
+        mail = changeMail([('Priority', 'P1', 'P2'),
+                           ('Severity', 'normal', 'major')])
+        mail.merge(changeMail([('Priority', 'P2', 'P1')]))
+        self.assertEqual(self._diffs(mail),
+                         [('Severity', 'normal', 'major')])
+
+    def testMergeKeepsFlagsAttachmentsAndMultiFields(self):
+        mail = changeMail([('Flags', '', 'review?'),
+                           ('CC', '', 'a@example.com'),
+                           ('Attachment #4 Flags', '', 'review?')])
+        mail.merge(changeMail([('Flags', 'review?', 'review+'),
+                               ('CC', '', 'b@example.com'),
+                               ('Attachment #4 Flags', 'review?',
+                                'review+')]))
+        whats = [d['what'] for d in mail.diffs()]
+        self.assertEqual(sorted(whats), ['Attachment Flags'] * 2
+                                        + ['CC'] * 2 + ['Flags'] * 2)
+        self.assertEqual([d['added'] for d in mail.diffs()
+                          if d['what'] == 'CC'],
+                         ['a@example.com', 'b@example.com'])
+
+    def testCanMergeOnlySameChanger(self):
+        mail = changeMail([('Priority', 'P1', 'P2')])
+        self.failUnless(mail.canMerge(changeMail([('Priority', 'P2', 'P3')])))
+        other = changeMail([('Priority', 'P2', 'P3')],
+                           who='jane@example.com')
+        self.failIf(mail.canMerge(other))
+        self.failIf(mail.canMerge(bugmail.parseText(BUGMAIL)[0]))
+
 class BugzillaTestCase(ChannelPluginTestCase):
-    plugins = ('Bugzilla')
-    config = {'supybot.plugins.Bugzilla.mbox': 'test/mbox'
-              'supybot.plugins.Bugzilla.reportedChanges': ['All', 'newBug', 
-                                                           'newAttach']}
+    plugins = ('Bugzilla',)
+    config = {'supybot.plugins.Bugzilla.prefetch': False}
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        self.cb = self.irc.getCallback('Bugzilla')
+        state = conf.supybot.directories.data.dirize('Bugzilla.mbox')
+        if os.path.exists(state):
+            os.remove(state)
+        fd, self.mbox = tempfile.mkstemp()
+        os.close(fd)
+        conf.supybot.plugins.Bugzilla.mbox.setValue(self.mbox)
+
+    def tearDown(self):
+        conf.supybot.plugins.Bugzilla.mbox.setValue('')
+        os.remove(self.mbox)
+        ChannelPluginTestCase.tearDown(self)
+
+    def _deliver(self, *messages):
+        f = open(self.mbox, 'ab')
+        for message in messages:
+            f.write('From bugzilla-daemon@example.com Mon Jan  1 00:00:00'
+                    ' 2007\n%s\n' % message)
+        f.close()
+
+    def testPollMbox(self):
+        self._deliver(BUGMAIL, 'Subject: Not bugmail\n\nHello.\n')
+        self.cb._pollMbox()
+        reader = self.cb.mboxReader
+        self.assertEqual(reader.offset, os.path.getsize(self.mbox))
+        self.assertEqual(list(reader.read()), [])
+
+        self._deliver(BUGMAIL.replace('New: ', ''))
+        self.cb._pollMbox()
+        self.assertEqual(reader.offset, os.path.getsize(self.mbox))
+
+class RestStub(BaseHTTPServer.BaseHTTPRequestHandler):
+    """A Bugzilla REST API that knows bugs 1 and 3, and won't show us 2."""
+    requests = []
+
+    def do_GET(self):
+        RestStub.requests.append(self.path)
+        path, _, query = self.path.partition('?')
+        params = urlparse.parse_qs(query)
+        if path == '/rest/bug':
+            ids = params.get('id', [])
+            data = {'bugs': [{'id': int(i), 'summary': 'Bug %s' % i,
+                              'status': 'NEW'} for i in ids if i != '2'],
+                    'faults': [{'id': 2, 'faultCode': 102,
+                                'faultString': 'Not allowed.'}
+                               for i in ids if i == '2']}
+        elif path.startswith('/rest/bug/') and path.endswith('/attachment'):
+            ids = [path.split('/')[3]] + params.get('ids', [])
+            data = {'bugs': dict([(i, [{'id': 10 + int(i), 'bug_id': int(i),
+                                        'is_patch': 1, 'summary': 'Patch'}])
+                                  for i in ids])}
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class BugzillaRestTestCase(ChannelPluginTestCase):
+    plugins = ('Bugzilla',)
+    config = {'supybot.plugins.Bugzilla.prefetch': False}
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        RestStub.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RestStub)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        plugin.registerBugzilla('stub', 'http://127.0.0.1:%s/'
+                                        % self.server.server_port)
+        conf.supybot.plugins.Bugzilla.bugzillas.stub.backend.setValue('rest')
+        self.cb = self.irc.getCallback('Bugzilla')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        ChannelPluginTestCase.tearDown(self)
+
+    def testGetBugs(self):
+        backend = plugin.BugzillaInstall(self.cb, 'stub').backend
+        bugs = backend.getBugs(['1', '2', '3'], ['short_desc'], ['desc'],
+                               attachments=True)
+        self.assertEqual([bug.bug_id for bug in bugs], ['1', '2', '3'])
+        self.assertEqual(bugs[0]['short_desc'], 'Bug 1')
+        self.assertEqual(bugs[1].error, 'NotPermitted')
+        self.assertEqual([a['attachid'] for a in bugs[2].attachments],
+                         ['13'])
+        # One request for the bugs, and one for all of their attachments.
+        self.assertEqual(len(RestStub.requests), 2)
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
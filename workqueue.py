@@ -0,0 +1,100 @@
+###
+# Copyright (c) 2007, Max Kanat-Alexander
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+
+import sqlite3
+import threading
+import cPickle as pickle
+from time import time
+
+class WorkQueue(object):
+    """A queue of parsed bugmails, stored in an SQLite database so that it
+    survives crashes and restarts. A bugmail stays in the queue until it
+    has been announced and acknowledged with ack()."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS bugmails (
+                                queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                mail     BLOB NOT NULL,
+                                added    REAL NOT NULL)""")
+        self._db.commit()
+
+    def put(self, mail):
+        """Adds a bugmail to the end of the queue, and returns its id."""
+        data = sqlite3.Binary(pickle.dumps(mail, pickle.HIGHEST_PROTOCOL))
+        self._lock.acquire()
+        try:
+            cursor = self._db.execute(
+                'INSERT INTO bugmails (mail, added) VALUES (?, ?)',
+                (data, time()))
+            self._db.commit()
+            return cursor.lastrowid
+        finally:
+            self._lock.release()
+
+    def pending(self, limit, after=0):
+        """Returns up to limit (queue_id, bugmail) tuples from the front of
+        the queue, in order, skipping those with a queue_id of after or
+        less. bugmail is None if it can't be unpickled (because the
+        Bugmail class has changed since it was queued)."""
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(
+                'SELECT queue_id, mail FROM bugmails WHERE queue_id > ?'
+                ' ORDER BY queue_id LIMIT ?', (after, limit)).fetchall()
+        finally:
+            self._lock.release()
+        pending = []
+        for queue_id, data in rows:
+            try:
+                mail = pickle.loads(str(data))
+            except Exception:
+                mail = None
+            pending.append((queue_id, mail))
+        return pending
+
+    def ack(self, queue_id):
+        """Removes a bugmail from the queue, once it has been announced."""
+        self._lock.acquire()
+        try:
+            self._db.execute('DELETE FROM bugmails WHERE queue_id = ?',
+                             (queue_id,))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()